@@ -0,0 +1,62 @@
+''' Average the parameters of several checkpoints of one training run into a single checkpoint. '''
+import os
+import glob
+import argparse
+
+import torch
+
+
+def average_checkpoints(paths):
+    '''
+    Average the float tensors of the 'model' and 'encoder' state dicts over paths,
+    everything else (settings, epoch, integer buffers) comes from the last checkpoint.
+    '''
+    sums, checkpoint = {}, None
+    for path in paths:
+        checkpoint = torch.load(path, map_location='cpu')
+        for key in ('model', 'encoder'):
+            for name, tensor in checkpoint.get(key, {}).items():
+                if not tensor.is_floating_point():
+                    continue
+                key_sums = sums.setdefault(key, {})
+                if name in key_sums:
+                    key_sums[name] += tensor.double()
+                else:
+                    key_sums[name] = tensor.double().clone()
+
+    for key, key_sums in sums.items():
+        for name, total in key_sums.items():
+            checkpoint[key][name] = (total / len(paths)).to(checkpoint[key][name].dtype)
+    checkpoint['averaged_from'] = list(paths)
+    return checkpoint
+
+
+def main():
+    '''
+    Usage: python average_checkpoints.py -inputs output/vae/epoch_*.chkpt -last 5 -output output/vae/avg.chkpt
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-inputs', nargs='+', required=True,
+                        help='Checkpoint files or glob patterns of one training run')
+    parser.add_argument('-last', type=int, default=None,
+                        help='Only average the K most recently written of them')
+    parser.add_argument('-output', required=True)
+
+    opt = parser.parse_args()
+
+    paths = sorted({path for pattern in opt.inputs for path in glob.glob(pattern)}, key=os.path.getmtime)
+    if opt.last:
+        paths = paths[-opt.last:]
+    if not paths:
+        parser.error('No checkpoint matches -inputs')
+
+    print('[Info] Averaging', len(paths), 'checkpoints:')
+    for path in paths:
+        print('  -', path)
+    torch.save(average_checkpoints(paths), opt.output)
+    print('[Info] Saved to', opt.output)
+
+
+if __name__ == '__main__':
+    main()
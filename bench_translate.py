@@ -0,0 +1,239 @@
+''' Benchmark decoding costs with a randomly initialized model. '''
+import os
+import argparse
+import tempfile
+import time
+
+import torch
+import torch.nn.functional as F
+
+from transformer.Models import Transformer, get_pad_mask, get_subsequent_mask
+from transformer.Translator import Translator, CompiledTranslator
+from transformer.Shortlist import Shortlist
+from transformer.Export import export_torchscript
+
+
+def measure(fn, n_repeat, device):
+    ''' Average wall time of fn in milliseconds. '''
+    fn()    # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_repeat * 1000
+
+
+def saved_tensor_bytes(fn):
+    ''' Bytes of the distinct storages autograd keeps for the backward pass while fn runs. '''
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values())
+
+
+def bench_output_layer(model, opt, device):
+    ''' Scoring a decoder output: softmax over every position vs log_softmax of the last one. '''
+
+    print('[Info] Output layer per decoding step (ms)')
+    for step in opt.steps:
+        dec_output = torch.randn(opt.beam_size, step, opt.d_model, device=device)
+
+        def before():
+            probs = F.softmax(model.trg_word_prj(dec_output), dim=-1)
+            best_k_probs, _ = probs[:, -1, :].topk(opt.beam_size)
+            return torch.log(best_k_probs)
+
+        def after():
+            log_probs = F.log_softmax(model.trg_word_prj(dec_output[:, -1]), dim=-1)
+            best_k_log_probs, _ = log_probs.topk(opt.beam_size)
+            return best_k_log_probs
+
+        print(f'  - step {step:4d}  before: {measure(before, opt.n_repeat, device):8.3f}'
+              f'  after: {measure(after, opt.n_repeat, device):8.3f}')
+
+
+def bench_compiled(model, opt, device):
+    ''' Startup and decoding step latency of the eager model vs its TorchScript export. '''
+
+    translator_opt = argparse.Namespace(task_type=None)
+    translator = Translator(
+        translator_opt, model, beam_size=opt.beam_size, max_seq_len=max(opt.steps) + 1,
+        src_pad_idx=1, trg_pad_idx=1, trg_bos_idx=2, trg_eos_idx=3).to(device)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path, prefix = os.path.join(tmp_dir, 'model.chkpt'), os.path.join(tmp_dir, 'model')
+        torch.save({'model': model.state_dict()}, checkpoint_path)
+        export_torchscript(translator, prefix)
+
+        def load_eager():
+            build_model(opt).to(device).load_state_dict(torch.load(checkpoint_path, map_location=device)['model'])
+
+        def load_compiled():
+            return CompiledTranslator(translator_opt, prefix, opt.beam_size, max(opt.steps) + 1, map_location=device)
+
+        print('[Info] Startup (ms)')
+        print(f'  - eager: {measure(load_eager, 3, device):8.1f}  compiled: {measure(load_compiled, 3, device):8.1f}')
+        compiled = load_compiled()
+
+    src_seq = torch.randint(4, opt.vocab_size, (1, 20), device=device)
+    src_mask = get_pad_mask(src_seq, 1)
+    words = torch.full((opt.beam_size,), 2, dtype=torch.long, device=device)
+
+    print('[Info] Decoding step, averaged over the first n steps (ms)')
+    for step in opt.steps:
+
+        def decode(translator):
+            state = translator._init_state(src_seq, src_mask)
+            for _ in range(step):
+                translator._decode_step(words, src_mask, state)
+
+        print(f'  - n {step:4d}  eager: {measure(lambda: decode(translator), opt.n_repeat, device) / step:8.3f}'
+              f'  compiled: {measure(lambda: decode(compiled), opt.n_repeat, device) / step:8.3f}')
+
+
+def bench_shortlist(model, opt, device):
+    '''
+    Decoding step latency of a batch of 8 sentences, the output layer over the whole vocabulary
+    vs over -n_cand shortlisted words per sentence, with the beam search top-k of each step.
+    '''
+
+    translator_opt = argparse.Namespace(task_type=None)
+    src_seq = torch.randint(4, opt.vocab_size, (8, 20), device=device)
+    src_mask = get_pad_mask(src_seq, 1)
+    words = torch.full((src_seq.size(0) * opt.beam_size,), 2, dtype=torch.long, device=device)
+    table = {'frequent': torch.randperm(opt.vocab_size - 4)[:opt.n_cand].add(4).tolist(),
+             'lexical': {}, 'copy': {}, 'trg_vocab_size': opt.vocab_size}
+
+    translators = [('full', None), (f'shortlist of {opt.n_cand}', Shortlist(table, trg_pad_idx=1))]
+    print('[Info] Decoding step, averaged over the first n steps (ms)')
+    for step in opt.steps:
+        elapses = []
+        for name, shortlist in translators:
+            translator = Translator(
+                translator_opt, model, beam_size=opt.beam_size, max_seq_len=max(opt.steps) + 1,
+                src_pad_idx=1, trg_pad_idx=1, trg_bos_idx=2, trg_eos_idx=3, shortlist=shortlist).to(device)
+
+            def decode():
+                state = translator._init_state(src_seq, src_mask)
+                for _ in range(step):
+                    log_probs = translator._decode_step(words, src_mask, state)
+                    log_probs.view(src_seq.size(0), -1).topk(2 * opt.beam_size)
+
+            elapses.append(f'{name}: {measure(decode, opt.n_repeat, device) / step:8.3f}')
+        print(f'  - n {step:4d}  ' + '  '.join(elapses))
+
+
+def bench_train_memory(model, opt, device):
+    '''
+    Peak memory and time of a training step over -b sentences of -seq_len tokens, the way
+    Transformer.forward trains unpadded targets (the causal flag, no attention weights) vs an explicit target mask,
+    with and without the attention weights of every layer kept (return_attns).
+    Peak memory is tracked on CUDA only, the activations saved for the backward pass everywhere.
+    With -no_dropout the steps run with the dropout layers off, on CPU F.scaled_dot_product_attention
+    only uses its fused kernel without attention dropout.
+    '''
+
+    src_seq = torch.randint(4, opt.vocab_size, (opt.b, opt.seq_len), device=device)
+    trg_seq = torch.randint(4, opt.vocab_size, (opt.b, opt.seq_len), device=device)
+    src_mask = get_pad_mask(src_seq, 1)
+    trg_mask = get_pad_mask(trg_seq, 1) & get_subsequent_mask(trg_seq)
+
+    def masked_logits(return_attns):
+        enc_output, *_ = model.encoder(src_seq, src_mask, return_attns=return_attns)
+        dec_output, *_ = model.decoder(trg_seq, trg_mask, enc_output, src_mask, return_attns=return_attns)
+        seq_logit = model.trg_word_prj(dec_output)
+        if model.scale_prj:
+            seq_logit *= model.d_model ** -0.5
+        return seq_logit.view(-1, seq_logit.size(2))
+
+    steps = (
+        ('weights kept, mask', lambda: masked_logits(True)),
+        ('on demand, mask', lambda: masked_logits(False)),
+        ('on demand, is_causal', lambda: model(src_seq, trg_seq)))
+
+    def train_step(forward):
+        loss = F.cross_entropy(forward(), trg_seq.view(-1))
+        loss.backward()
+        model.zero_grad()
+
+    print(f'[Info] Training step over {opt.b} x {opt.seq_len} tokens' + (', no dropout' if opt.no_dropout else '')
+          + (f', every {opt.checkpoint_every} layer(s) checkpointed' if opt.checkpoint_every else ''))
+    model.train(not opt.no_dropout)
+    with torch.enable_grad():
+        for name, forward in steps:
+            elapse = measure(lambda: train_step(forward), opt.n_repeat, device)
+            saved = saved_tensor_bytes(lambda: train_step(forward))
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+                train_step(forward)
+                peak = f'{torch.cuda.max_memory_allocated(device) / 2 ** 20:8.1f} MiB'
+            else:
+                peak = 'not tracked on CPU'
+            print(f'  - {name:22}  time: {elapse:8.1f} ms  saved for backward: {saved / 2 ** 20:8.1f} MiB'
+                  f'  peak memory: {peak}')
+    model.eval()
+
+
+def build_model(opt):
+    return Transformer(
+        opt.vocab_size, opt.vocab_size, src_pad_idx=1, trg_pad_idx=1,
+        d_word_vec=opt.d_model, d_model=opt.d_model, d_inner=opt.d_inner_hid,
+        n_layers=opt.n_layers, n_head=opt.n_head,
+        d_k=opt.d_model // opt.n_head, d_v=opt.d_model // opt.n_head,
+        checkpoint_every=opt.checkpoint_every)
+
+
+def main():
+    '''
+    Usage: python bench_translate.py -bench output_layer -vocab_size 32000 -no_cuda
+           python bench_translate.py -bench train_memory -b 2048 -seq_len 32
+           python bench_translate.py -bench train_memory -b 2048 -seq_len 32 -checkpoint_every 1
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-bench', nargs='+', default=['output_layer'],
+                        choices=['output_layer', 'compiled', 'shortlist', 'train_memory'])
+    parser.add_argument('-vocab_size', type=int, default=32000)
+    parser.add_argument('-d_model', type=int, default=512)
+    parser.add_argument('-d_inner_hid', type=int, default=2048)
+    parser.add_argument('-n_head', type=int, default=8)
+    parser.add_argument('-n_layers', type=int, default=6)
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-steps', type=int, nargs='+', default=[10, 25, 50, 100])
+    parser.add_argument('-n_cand', type=int, default=2000,
+                        help='Shortlisted words per sentence of the shortlist bench')
+    parser.add_argument('-n_repeat', type=int, default=20)
+    parser.add_argument('-b', type=int, default=2048,
+                        help='Sentences per training batch of the train_memory bench, as train_vae_nmt.py -b')
+    parser.add_argument('-seq_len', type=int, default=32)
+    parser.add_argument('-no_dropout', action='store_true',
+                        help='Train without dropout in the train_memory bench')
+    parser.add_argument('-checkpoint_every', type=int, default=0,
+                        help='Recompute the activations of every k-th layer in the train_memory bench, '
+                             'as train_vae_nmt.py -checkpoint_every')
+    parser.add_argument('-no_cuda', action='store_true')
+
+    opt = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() and not opt.no_cuda else 'cpu')
+
+    model = build_model(opt).to(device)
+    model.eval()
+
+    benches = {'output_layer': bench_output_layer, 'compiled': bench_compiled,
+               'shortlist': bench_shortlist, 'train_memory': bench_train_memory}
+    with torch.no_grad():
+        for name in opt.bench:
+            benches[name](model, opt, device)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+''' Build the lexical table of the vocabulary shortlist out of the training pickle, see transformer/Shortlist.py. '''
+import pickle
+import argparse
+from collections import Counter, defaultdict
+
+import dill
+
+import transformer.Constants as Constants
+
+
+def build_table(examples, src_stoi, trg_stoi, trg_itos, n_frequent=1000, n_lexical=20, min_count=2):
+    '''
+    frequent: the n_frequent most frequent target words (and the special ones),
+    lexical: src id -> the n_lexical target ids of the sentences it co-occurs with the most,
+             ranked by their Dice coefficient 2 * c(s, t) / (c(s) + c(t)),
+    copy: src id -> the target id of the same token, for names and numbers copied over.
+    '''
+    src_counts, trg_counts = Counter(), Counter()
+    pair_counts = defaultdict(Counter)
+    trg_freqs = Counter()
+    for example in examples:
+        src_ids = {src_stoi[w] for w in example.src if w in src_stoi}
+        trg_ids = [trg_stoi[w] for w in example.trg if w in trg_stoi]
+        trg_freqs.update(trg_ids)
+        trg_ids = set(trg_ids)
+        src_counts.update(src_ids)
+        trg_counts.update(trg_ids)
+        for src_idx in src_ids:
+            pair_counts[src_idx].update(trg_ids)
+
+    specials = [trg_stoi[w] for w in (Constants.UNK_WORD, Constants.EOS_WORD) if w in trg_stoi]
+    frequent = specials + [idx for idx, _ in trg_freqs.most_common(n_frequent)]
+
+    lexical = {}
+    for src_idx, counts in pair_counts.items():
+        scored = [(2 * count / (src_counts[src_idx] + trg_counts[trg_idx]), trg_idx)
+                  for trg_idx, count in counts.items() if count >= min_count]
+        scored.sort(reverse=True)
+        lexical[src_idx] = [trg_idx for _, trg_idx in scored[:n_lexical]]
+
+    copy = {src_idx: trg_stoi[w] for w, src_idx in src_stoi.items() if w in trg_stoi}
+    pad_idx = trg_stoi.get(Constants.PAD_WORD)
+    copy = {src_idx: trg_idx for src_idx, trg_idx in copy.items() if trg_idx != pad_idx}
+    return {'frequent': frequent, 'lexical': lexical, 'copy': copy, 'trg_vocab_size': len(trg_itos)}
+
+
+def main():
+    '''
+    Usage: python build_shortlist.py -data_pkl m30k_deen_shr.pkl -output m30k_deen_shr.shortlist.pkl
+           python translate.py -model trained.chkpt -data_pkl m30k_deen_shr.pkl -shortlist m30k_deen_shr.shortlist.pkl
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-data_pkl', required=True,
+                        help='Pickle written by nmt_preprocess.py, with its training examples')
+    parser.add_argument('-output', required=True)
+    parser.add_argument('-n_frequent', type=int, default=1000,
+                        help='Most frequent target words every sentence gets')
+    parser.add_argument('-n_lexical', type=int, default=20,
+                        help='Target words kept per source word')
+    parser.add_argument('-min_count', type=int, default=2,
+                        help='Sentence pairs a source and a target word need to share')
+
+    opt = parser.parse_args()
+
+    data = dill.load(open(opt.data_pkl, 'rb'))
+    SRC, TRG = data['vocab']['src'], data['vocab']['trg']
+    table = build_table(data['train'], SRC.vocab.stoi, TRG.vocab.stoi, TRG.vocab.itos,
+                        opt.n_frequent, opt.n_lexical, opt.min_count)
+
+    n_lexical = sum(len(trg_ids) for trg_ids in table['lexical'].values()) / max(1, len(table['lexical']))
+    print('[Info] {} frequent words, {:.1f} lexical candidates per source word, {} copyable words'.format(
+        len(table['frequent']), n_lexical, len(table['copy'])))
+    with open(opt.output, 'wb') as f:
+        pickle.dump(table, f)
+    print('[Info] Saved to', opt.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+''' Compare BLEU and decoding speed of a checkpoint before and after int8 quantization. '''
+import sys
+import time
+import argparse
+
+import torch
+from torchtext.data.metrics import bleu_score
+
+import transformer.Constants as Constants
+from transformer.Translator import Translator
+from transformer.Quantization import quantize_dynamic_int8
+from translate import load_model, translate_seqs
+from vocab import load_vocab, load_examples
+
+
+def evaluate(opt, src_vocab, trg_vocab, examples, quantize):
+    ''' BLEU against the references, and sentences per second. '''
+    device = torch.device('cpu')
+    model = load_model(opt, device)
+    if quantize:
+        model = quantize_dynamic_int8(model)
+    translator = Translator(opt,
+                            model=model,
+                            beam_size=opt.beam_size,
+                            max_seq_len=opt.max_seq_len,
+                            src_pad_idx=opt.src_pad_idx,
+                            trg_pad_idx=opt.trg_pad_idx,
+                            trg_bos_idx=opt.trg_bos_idx,
+                            trg_eos_idx=opt.trg_eos_idx,
+                            max_len_a=opt.max_len_a,
+                            max_len_b=opt.max_len_b,
+                            early_stop=opt.early_stop).to(device)
+
+    src_seqs = [src_vocab.encode(example['src']) for example in examples]
+    start = time.time()
+    pred_seqs = translate_seqs(translator, src_seqs, opt, device)
+    elapsed = time.time() - start
+
+    specials = {opt.trg_bos_idx, opt.trg_eos_idx, opt.trg_pad_idx}
+    candidates = [trg_vocab.decode([idx for idx in pred_seq if idx not in specials]) for pred_seq in pred_seqs]
+    references = [[example['trg']] for example in examples]
+    return bleu_score(candidates, references) * 100, len(examples) / elapsed
+
+
+def main():
+    '''
+    Usage: python eval_quantize.py -model trained.chkpt -vocab_pkl vocab.pkl -test_pkl test.pkl -n_sents 1000
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-model', required=True,
+                        help='Path to model weight file')
+    parser.add_argument('-vocab_pkl', required=True,
+                        help='Vocabulary written by nmt_preprocess.py -save_vocab')
+    parser.add_argument('-test_pkl', required=True,
+                        help='Held-out split written by nmt_preprocess.py -save_test')
+    parser.add_argument('-n_sents', type=int, default=None,
+                        help='Only use the first n sentences of the held-out split')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=0)
+    parser.add_argument('-max_len_b', type=int, default=0)
+    parser.add_argument('-early_stop', action='store_true')
+    parser.add_argument('-batch_size', type=int, default=30)
+    parser.add_argument('-max_tokens', type=int, default=None)
+    parser.add_argument('-n_threads', type=int, default=None,
+                        help='Intra-op threads, the default is left to torch')
+    parser.add_argument('-variational', action='store_true')
+    parser.add_argument('-split', action='store_true')
+    parser.add_argument('-task_type', type=str, default=None, choices=["tst", "nmt"])
+
+    opt = parser.parse_args()
+    opt.workers = 1
+    if opt.n_threads:
+        torch.set_num_threads(opt.n_threads)
+
+    src_vocab, trg_vocab, _ = load_vocab(opt.vocab_pkl)
+    examples = load_examples(opt.test_pkl)[:opt.n_sents]
+    opt.src_pad_idx = src_vocab.stoi[Constants.PAD_WORD]
+    opt.trg_pad_idx = trg_vocab.stoi[Constants.PAD_WORD]
+    opt.trg_bos_idx = trg_vocab.stoi[Constants.BOS_WORD]
+    opt.trg_eos_idx = trg_vocab.stoi[Constants.EOS_WORD]
+
+    fp32_bleu, fp32_speed = evaluate(opt, src_vocab, trg_vocab, examples, quantize=False)
+    int8_bleu, int8_speed = evaluate(opt, src_vocab, trg_vocab, examples, quantize=True)
+
+    print('[Info] {} sentences, beam size {}, {} threads'.format(
+        len(examples), opt.beam_size, torch.get_num_threads()), file=sys.stderr)
+    print('  - fp32  BLEU: {:6.2f}  sentences/s: {:8.2f}'.format(fp32_bleu, fp32_speed))
+    print('  - int8  BLEU: {:6.2f}  sentences/s: {:8.2f}'.format(int8_bleu, int8_speed))
+    print('  - delta BLEU: {:+6.2f}  speedup: {:8.2f}x'.format(int8_bleu - fp32_bleu, int8_speed / fp32_speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+''' Export a trained checkpoint into a compiled encoder and a single decoding step. '''
+import argparse
+
+import torch
+
+import transformer.Constants as Constants
+from transformer.Translator import Translator
+from transformer.Export import export_torchscript, export_onnx
+from vocab import load_vocab
+
+
+def main():
+    '''
+    Usage: python export_model.py -model trained.chkpt -vocab_pkl vocab.pkl -output exported/model
+           python translate.py -compiled exported/model -vocab_pkl vocab.pkl -test_pkl test.pkl -no_cuda
+           python export_model.py -model trained.chkpt -vocab_pkl vocab.pkl -output exported/model -format onnx
+           python ort_translate.py -model exported/model -vocab_pkl vocab.pkl -test_pkl test.pkl
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-model', required=True,
+                        help='Path to model weight file')
+    parser.add_argument('-vocab_pkl', required=True,
+                        help='Vocabulary written by nmt_preprocess.py -save_vocab')
+    parser.add_argument('-output', required=True,
+                        help='Prefix of the exported files')
+    parser.add_argument('-format', default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('-tm', action='store_true',
+                        help='The checkpoint is a transformer.TM_Models one, as in tm_translate.py')
+    parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-variational', action='store_true')
+    parser.add_argument('-split', action='store_true')
+    parser.add_argument('-task_type', type=str, default=None, choices=["tst", "nmt"])
+
+    opt = parser.parse_args()
+    opt.cuda = not opt.no_cuda
+
+    if opt.tm:
+        from tm_translate import load_model
+    else:
+        from translate import load_model
+
+    src_vocab, trg_vocab, _ = load_vocab(opt.vocab_pkl)
+    device = torch.device('cuda' if opt.cuda else 'cpu')
+    translator = Translator(opt,
+                            model=load_model(opt, device),
+                            beam_size=1,
+                            max_seq_len=1,
+                            src_pad_idx=src_vocab.stoi[Constants.PAD_WORD],
+                            trg_pad_idx=trg_vocab.stoi[Constants.PAD_WORD],
+                            trg_bos_idx=trg_vocab.stoi[Constants.BOS_WORD],
+                            trg_eos_idx=trg_vocab.stoi[Constants.EOS_WORD]).to(device)
+
+    if opt.format == 'torchscript':
+        export_torchscript(translator, opt.output)
+    elif opt.format == 'onnx':
+        export_onnx(translator, opt.output)
+    print('[Info] Exported to', opt.output + '.*')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import numpy as np
 from models.jadore.layer import EncoderLayer, DecoderLayer
+from transformer.Modules import get_causal_mask
 
 
 def get_pad_mask(seq, pad_idx):
@@ -9,11 +10,9 @@ def get_pad_mask(seq, pad_idx):
 
 
 def get_subsequent_mask(seq):
-    ''' For masking out the subsequent info. '''
+    ''' For masking out the subsequent info, a view of the mask cached for seq.device. '''
     sz_b, len_s = seq.size()
-    subsequent_mask = (1 - torch.triu(
-        torch.ones((1, len_s, len_s), device=seq.device), diagonal=1)).bool()
-    return subsequent_mask
+    return get_causal_mask(len_s, seq.device)
 
 
 class PositionalEncoding(nn.Module):
@@ -37,8 +36,8 @@ class PositionalEncoding(nn.Module):
 
         return torch.FloatTensor(sinusoid_table).unsqueeze(0)
 
-    def forward(self, x):
-        return x + self.pos_table[:, :x.size(1)].clone().detach()
+    def forward(self, x, start=0):
+        return x + self.pos_table[:, start:start + x.size(1)].clone().detach()
 
 
 class Encoder(nn.Module):
@@ -99,20 +98,34 @@ class Decoder(nn.Module):
         self.scale_emb = scale_emb
         self.d_model = d_model
 
-    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False):
+    def init_cache(self):
+        ''' Per-layer self attention key/value caches for incremental decoding. '''
+        return [{} for _ in self.layer_stack]
+
+    def reorder_cache(self, cache, beam_idx):
+        ''' Move the cached keys/values along with their beams. '''
+        for layer_cache in cache:
+            for key, value in layer_cache.items():
+                layer_cache[key] = value.index_select(0, beam_idx)
+
+    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False, cache=None):
 
         dec_slf_attn_list, dec_enc_attn_list = [], []
 
+        # With a cache, trg_seq only holds the newest tokens, the earlier ones are in the cache.
+        start = cache[0]['k'].size(2) if cache and 'k' in cache[0] else 0
+
         # -- Forward
         dec_output = self.trg_word_emb(trg_seq)
         if self.scale_emb:
             dec_output *= self.d_model ** 0.5
-        dec_output = self.dropout(self.position_enc(dec_output))
+        dec_output = self.dropout(self.position_enc(dec_output, start))
         dec_output = self.layer_norm(dec_output)
 
-        for dec_layer in self.layer_stack:
+        for i, dec_layer in enumerate(self.layer_stack):
             dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
-                dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask)
+                dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask,
+                cache=None if cache is None else cache[i])
             dec_slf_attn_list += [dec_slf_attn] if return_attns else []
             dec_enc_attn_list += [dec_enc_attn] if return_attns else []
 
@@ -26,43 +26,40 @@ class Translator(nn.Module):
         self.model.eval()
 
         self.register_buffer('init_seq', torch.LongTensor([[trg_bos_idx]]))
-        self.register_buffer(
-            'blank_seqs',
-            torch.full((beam_size, max_seq_len), trg_pad_idx, dtype=torch.long))
-        self.blank_seqs[:, 0] = self.trg_bos_idx
-        self.register_buffer(
-            'len_map',
-            torch.arange(1, max_seq_len + 1, dtype=torch.long).unsqueeze(0))
-
-    def _model_decode(self, trg_seq, enc_output, src_mask):
-        trg_mask = get_subsequent_mask(trg_seq)
-        dec_output, *_ = self.model.decoder(trg_seq, trg_mask, enc_output, src_mask)
-        return F.softmax(self.model.trg_word_prj(dec_output), dim=-1)
+
+    def _model_decode(self, trg_seq, enc_output, src_mask, cache=None):
+        # With a cache, trg_seq is the newest token only and may attend to everything cached.
+        trg_mask = None if cache is not None else get_subsequent_mask(trg_seq)
+        dec_output, *_ = self.model.decoder(trg_seq, trg_mask, enc_output, src_mask, cache=cache)
+        # Only the last position is scored, in log space.
+        return F.log_softmax(self.model.trg_word_prj(dec_output[:, -1]), dim=-1)
 
     def _get_init_state(self, src_seq, src_mask):
         beam_size = self.beam_size
 
         enc_output, *_ = self.model.encoder(src_seq, src_mask)
-        dec_output = self._model_decode(self.init_seq, enc_output, src_mask)
+        cache = self.model.decoder.init_cache()
+        log_probs = self._model_decode(self.init_seq, enc_output, src_mask, cache)
 
-        best_k_probs, best_k_idx = dec_output[:, -1, :].topk(beam_size)
+        best_k_log_probs, best_k_idx = log_probs.topk(beam_size)
 
-        scores = torch.log(best_k_probs).view(beam_size)
-        gen_seq = self.blank_seqs.clone().detach()
-        gen_seq[:, 1] = best_k_idx[0]
+        scores = best_k_log_probs.view(beam_size)
+        words = best_k_idx.view(beam_size)
+        # Every beam starts from the cached BOS step.
+        self.model.decoder.reorder_cache(cache, best_k_idx.new_zeros(beam_size))
         enc_output = enc_output.repeat(beam_size, 1, 1)
-        return enc_output, gen_seq, scores
+        return enc_output, words, scores, cache
 
-    def _get_the_best_score_and_idx(self, gen_seq, dec_output, scores, step):
+    def _get_the_best_score_and_idx(self, log_probs, scores):
         assert len(scores.size()) == 1
 
         beam_size = self.beam_size
 
         # Get k candidates for each beam, k^2 candidates in total.
-        best_k2_probs, best_k2_idx = dec_output[:, -1, :].topk(beam_size)
+        best_k2_log_probs, best_k2_idx = log_probs.topk(beam_size)
 
         # Include the previous scores.
-        scores = torch.log(best_k2_probs).view(beam_size, -1) + scores.view(beam_size, 1)
+        scores = best_k2_log_probs.view(beam_size, -1) + scores.view(beam_size, 1)
 
         # Get the best k candidates from k^2 candidates.
         scores, best_k_idx_in_k2 = scores.view(-1).topk(beam_size)
@@ -71,12 +68,7 @@ class Translator(nn.Module):
         best_k_r_idxs, best_k_c_idxs = best_k_idx_in_k2 // beam_size, best_k_idx_in_k2 % beam_size
         best_k_idx = best_k2_idx[best_k_r_idxs, best_k_c_idxs]
 
-        # Copy the corresponding previous tokens.
-        gen_seq[:, :step] = gen_seq[best_k_r_idxs, :step]
-        # Set the best tokens in this beam search step
-        gen_seq[:, step] = best_k_idx
-
-        return gen_seq, scores
+        return scores, best_k_r_idxs, best_k_idx
 
     def translate_sentence(self, src_seq):
         # Only accept batch size equals to 1 in this function.
@@ -88,22 +80,40 @@ class Translator(nn.Module):
 
         with torch.no_grad():
             src_mask = get_pad_mask(src_seq, src_pad_idx)
-            enc_output, gen_seq, scores = self._get_init_state(src_seq, src_mask)
+            enc_output, words, scores, cache = self._get_init_state(src_seq, src_mask)
+
+            # -- (tokens, beams they extend) of every step, the hypotheses are rebuilt from them,
+            #    the decoder itself only reads the newest tokens, the earlier ones are in its cache
+            history = [(words, None)]
+            # -- length up to the first eos of every beam, max_seq_len if it has none
+            has_eos = words == trg_eos_idx
+            seq_lens = torch.full_like(words, max_seq_len).masked_fill(has_eos, 2)
 
             ans_idx = 0  # default
             for step in range(2, max_seq_len):  # decode up to max length
-                dec_output = self._model_decode(gen_seq[:, :step], enc_output, src_mask)
-                gen_seq, scores = self._get_the_best_score_and_idx(gen_seq, dec_output, scores, step)
+                log_probs = self._model_decode(words.unsqueeze(1), enc_output, src_mask, cache)
+                scores, best_k_r_idxs, best_k_idx = self._get_the_best_score_and_idx(log_probs, scores)
+                self.model.decoder.reorder_cache(cache, best_k_r_idxs)
+                words = best_k_idx
+                history.append((best_k_idx, best_k_r_idxs))
 
                 # Check if all path finished
-                # -- locate the eos in the generated sequences
-                eos_locs = gen_seq == trg_eos_idx
-                # -- replace the eos with its position for the length penalty use
-                seq_lens, _ = self.len_map.masked_fill(~eos_locs, max_seq_len).min(1)
+                # -- follow the beams and locate their first eos
+                has_eos, seq_lens = has_eos[best_k_r_idxs], seq_lens[best_k_r_idxs]
+                new_eos = (best_k_idx == trg_eos_idx) & ~has_eos
+                has_eos, seq_lens = has_eos | new_eos, seq_lens.masked_fill(new_eos, step + 1)
                 # -- check if all beams contain eos
-                if (eos_locs.sum(1) > 0).sum(0).item() == beam_size:
+                if has_eos.all().item():
                     # TODO: Try different terminate conditions.
                     _, ans_idx = scores.div(seq_lens.float() ** alpha).max(0)
                     ans_idx = ans_idx.item()
                     break
-        return gen_seq[ans_idx][:seq_lens[ans_idx]].tolist()
\ No newline at end of file
+
+        # Rebuild the answer by following its back pointers.
+        pred_seq, row = [], ans_idx
+        for best_k_idx, best_k_r_idxs in reversed(history):
+            pred_seq.append(best_k_idx.tolist()[row])
+            if best_k_r_idxs is not None:
+                row = best_k_r_idxs.tolist()[row]
+        pred_seq = [self.trg_bos_idx] + pred_seq[::-1]
+        return pred_seq[:seq_lens[ans_idx].item()]
\ No newline at end of file
@@ -138,6 +138,43 @@ class StylizedNMT(nn.Module):
 
         return outputs, output_list
 
+    def greedy_decode(self, nmt_src, bos_idx, eos_idx, max_len, pad_idx=0):
+        ''' Greedy decoding without teacher forcing, rows leave the batch once they produce EOS. '''
+        nmt_src = nmt_src.to(self.device)
+
+        with torch.no_grad():
+            encoder_out, hidden, cell = self.nmt_encoder(nmt_src)
+
+            if not self.total_latent is None:
+                hidden = self.hidden2concat(hidden)
+                latent = self.latent2concat(self.total_latent)
+                hidden = torch.cat((hidden, latent), 2)
+
+            batch_size = nmt_src.shape[0]
+            outputs = torch.full((batch_size, max_len), pad_idx, dtype=torch.long, device=self.device)
+            outputs[:, 0] = bos_idx
+            output_lens = torch.full((batch_size,), max_len, dtype=torch.long, device=self.device)
+
+            # batch position of the rows still being decoded
+            active = torch.arange(batch_size, device=self.device)
+            input = outputs[:, 0]
+            for i in range(1, max_len):
+                output, hidden, cell = self.nmt_decoder(input, hidden, cell)
+                input = output.argmax(1)
+                outputs[active, i] = input
+
+                ended = input == eos_idx
+                if ended.any():
+                    output_lens[active[ended]] = i + 1
+                    running = (~ended).nonzero().squeeze(1)
+                    if running.numel() == 0:
+                        break
+                    # hidden, cell : [n_layers * 2, batch, d_hidden]
+                    active, input = active[running], input[running]
+                    hidden, cell = hidden[:, running], cell[:, running]
+
+        return [out[:out_len] for out, out_len in zip(outputs.tolist(), output_lens.tolist())]
+
 
 class Encoder(nn.Module):
     def __init__(self, input_size, d_hidden, d_embed, n_layers, dropout, device):
@@ -30,9 +30,9 @@ class DecoderLayer(nn.Module):
 
     def forward(
             self, dec_input, enc_output,
-            slf_attn_mask=None, dec_enc_attn_mask=None):
+            slf_attn_mask=None, dec_enc_attn_mask=None, cache=None):
         dec_output, dec_slf_attn = self.slf_attn(
-            dec_input, dec_input, dec_input, mask=slf_attn_mask)
+            dec_input, dec_input, dec_input, mask=slf_attn_mask, cache=cache)
         dec_output, dec_enc_attn = self.enc_attn(
             dec_output, enc_output, enc_output, mask=dec_enc_attn_mask)
         dec_output = self.pos_ffn(dec_output)
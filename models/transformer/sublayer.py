@@ -1,5 +1,6 @@
 ''' Define the sublayers in encoder/decoder layer '''
 import numpy as np
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from models.transformer.module import ScaledDotProductAttention
@@ -27,7 +28,7 @@ class MultiHeadAttention(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, cache=None):
         # size (q, k, v) : [max_len, batch, d_model]
 
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
@@ -44,6 +45,12 @@ class MultiHeadAttention(nn.Module):
 
         # Transpose for attention dot product: lq x n x b x dv
         q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+        if cache is not None:
+            # Incremental decoding: also attend to the keys/values of the earlier steps.
+            if 'k' in cache:
+                k = torch.cat([cache['k'], k], dim=2)
+                v = torch.cat([cache['v'], v], dim=2)
+            cache['k'], cache['v'] = k, v
         # size (q, k, v) : [max_len, n_head, batch, d_k]
         # print("transpose:", q.size())
 
@@ -20,6 +20,7 @@ from torchtext.datasets import TranslationDataset
 from torchtext.data import TabularDataset
 
 import transformer.Constants as Constants
+from vocab import Vocab, save_vocab, save_examples
 from learn_bpe import learn_bpe
 from apply_bpe import BPE
 
@@ -258,6 +259,10 @@ def main_wo_bpe():
     parser.add_argument('-lang_src', choices=spacy_support_langs)
     parser.add_argument('-lang_trg', choices=spacy_support_langs)
     parser.add_argument('-save_data', required=True)
+    parser.add_argument('-save_vocab', default=None,
+                        help='Also write the vocabularies alone, enough for translation')
+    parser.add_argument('-save_test', default=None,
+                        help='Also write the tokens of the test split alone')
     parser.add_argument('-data_type', type=str, default=None, choices=["gyafc", "korpora", "aihub", "wmt16"])
     parser.add_argument('-data_dir', type=str, default=None, choices=[".data/gyafc", ".data/korpora", ".data/aihub", ".data/wmt16", ".data/multi30k"])
     parser.add_argument('-train_path', type=str, default="train.csv")
@@ -304,11 +309,14 @@ def main_wo_bpe():
             trg_sp = spm.SentencePieceProcessor()
             spm_dir = "data/tokenizer"
             if opt.tk_type == 'unigram':
-                src_sp.Load(os.path.join(spm_dir, "train_pair_eng_spm.model"))
-                trg_sp.Load(os.path.join(spm_dir, "train_pair_kor_spm.model"))
+                opt.src_spm_model = os.path.join(spm_dir, "train_pair_eng_spm.model")
+                opt.trg_spm_model = os.path.join(spm_dir, "train_pair_kor_spm.model")
             elif opt.tk_type == 'bpe':
-                src_sp.Load(os.path.join(spm_dir, "bpe", "train_pair_eng_spm_bpe.model"))
-                trg_sp.Load(os.path.join(spm_dir, "bpe", "train_pair_kor_spm_bpe.model"))
+                opt.src_spm_model = os.path.join(spm_dir, "bpe", "train_pair_eng_spm_bpe.model")
+                opt.trg_spm_model = os.path.join(spm_dir, "bpe", "train_pair_kor_spm_bpe.model")
+            # Kept in the settings, translate.py -src tokenizes raw text with the same models.
+            src_sp.Load(opt.src_spm_model)
+            trg_sp.Load(opt.trg_spm_model)
 
             src_sp.SetEncodeExtraOptions('bos:eos')
             trg_sp.SetEncodeExtraOptions('bos:eos')
@@ -324,11 +332,14 @@ def main_wo_bpe():
             trg_sp = spm.SentencePieceProcessor()
             spm_dir = "data/tokenizer"
             if opt.tk_type == 'unigram':
-                src_sp.Load(os.path.join(spm_dir, "train_total_eng_spm.model"))
-                trg_sp.Load(os.path.join(spm_dir, "train_total_kor_spm.model"))
+                opt.src_spm_model = os.path.join(spm_dir, "train_total_eng_spm.model")
+                opt.trg_spm_model = os.path.join(spm_dir, "train_total_kor_spm.model")
             elif opt.tk_type == 'bpe':
-                src_sp.Load(os.path.join(spm_dir, "bpe", "train_total_eng_spm_bpe.model"))
-                trg_sp.Load(os.path.join(spm_dir, "bpe", "train_total_kor_spm_bpe.model"))
+                opt.src_spm_model = os.path.join(spm_dir, "bpe", "train_total_eng_spm_bpe.model")
+                opt.trg_spm_model = os.path.join(spm_dir, "bpe", "train_total_kor_spm_bpe.model")
+            # Kept in the settings, translate.py -src tokenizes raw text with the same models.
+            src_sp.Load(opt.src_spm_model)
+            trg_sp.Load(opt.trg_spm_model)
 
             src_sp.SetEncodeExtraOptions('bos:eos')
             trg_sp.SetEncodeExtraOptions('bos:eos')
@@ -392,6 +403,13 @@ def main_wo_bpe():
     print('[Info] Dumping the processed data to pickle file', opt.save_data)
     pickle.dump(data, open(opt.save_data, 'wb'))
 
+    if opt.save_vocab:
+        print('[Info] Dumping the vocabulary to pickle file', opt.save_vocab)
+        save_vocab(opt.save_vocab, Vocab.from_field(SRC), Vocab.from_field(TRG), settings=vars(opt))
+    if opt.save_test:
+        print('[Info] Dumping the test split to pickle file', opt.save_test)
+        save_examples(opt.save_test, test.examples)
+
 
 if __name__ == '__main__':
     main_wo_bpe()
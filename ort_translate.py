@@ -0,0 +1,159 @@
+''' Translate with the ONNX graphs of export_model.py on onnxruntime, without PyTorch. '''
+import sys
+import json
+import argparse
+
+import numpy as np
+import onnxruntime as ort
+
+from transformer.Batching import token_budget_batches, pad_seqs
+from transformer.Search import BeamSearch
+from vocab import load_vocab, load_examples
+
+
+class OrtTranslator(BeamSearch):
+    '''
+    The search of transformer.Search on numpy arrays, over the encoder and
+    decoding step graphs written by export_model.py -format onnx.
+    '''
+
+    def __init__(
+            self, prefix, beam_size, max_seq_len,
+            max_len_a=0, max_len_b=0, early_stop=False, n_threads=None):
+
+        with open(prefix + '.json') as f:
+            meta = json.load(f)
+
+        self.alpha = 0.7
+        self.beam_size = beam_size
+        self.max_seq_len = max_seq_len
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.early_stop = early_stop
+        self.src_pad_idx = meta['src_pad_idx']
+        self.trg_pad_idx = meta['trg_pad_idx']
+        self.trg_bos_idx = meta['trg_bos_idx']
+        self.trg_eos_idx = meta['trg_eos_idx']
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        providers = ['CPUExecutionProvider']
+        self.encoder = ort.InferenceSession(prefix + '.encoder.onnx', options, providers=providers)
+        self.decoder_step = ort.InferenceSession(prefix + '.decoder_step.onnx', options, providers=providers)
+
+
+    def _init_state(self, src_seq, src_mask, n_samples=None):
+        if n_samples is not None:
+            raise ValueError('The exported encoder decodes from the latent mean only')
+        enc_k, enc_v = self.encoder.run(None, {'src_seq': src_seq})
+        return {'enc_k': enc_k, 'enc_v': enc_v, 'slf_k': None, 'slf_v': None}
+
+
+    def _decode_step(self, words, src_mask, state):
+        enc_k, enc_v = state['enc_k'], state['enc_v']
+        if state['slf_k'] is None:
+            n_layers, _, n_head, _, d_k = enc_k.shape
+            state['slf_k'] = np.zeros((n_layers, len(words), n_head, 0, d_k), dtype=enc_k.dtype)
+            state['slf_v'] = np.zeros((n_layers, len(words), n_head, 0, enc_v.shape[-1]), dtype=enc_v.dtype)
+        step = np.array([state['slf_k'].shape[3]], dtype=np.int64)
+        log_probs, state['slf_k'], state['slf_v'] = self.decoder_step.run(None, {
+            'words': words, 'step': step, 'src_mask': src_mask,
+            'enc_k': enc_k, 'enc_v': enc_v, 'slf_k': state['slf_k'], 'slf_v': state['slf_v']})
+        return log_probs
+
+
+    def _reorder_state(self, state, row_idx, enc_idx=None):
+        if state['slf_k'] is not None:
+            state['slf_k'], state['slf_v'] = state['slf_k'][:, row_idx], state['slf_v'][:, row_idx]
+        if enc_idx is not None:
+            state['enc_k'], state['enc_v'] = state['enc_k'][:, enc_idx], state['enc_v'][:, enc_idx]
+
+
+    def _full_ids(self, shape, value, like):
+        return np.full(shape, value, dtype=np.int64)
+
+
+    def _full_scores(self, shape, value, like):
+        return np.full(shape, value, dtype=np.float32)
+
+
+    def _ids(self, values, like):
+        return np.array(list(values), dtype=np.int64)
+
+
+    def _repeat_rows(self, x, n):
+        return np.repeat(x, n, axis=0)
+
+
+    def _max(self, x):
+        idx = x.argmax(-1)
+        return np.take_along_axis(x, idx[:, None], axis=1)[:, 0], idx
+
+
+    def _topk(self, x, k):
+        # Partition first, only the k picked get sorted.
+        idx = np.argpartition(-x, k - 1, axis=1)[:, :k]
+        values = np.take_along_axis(x, idx, axis=1)
+        order = np.argsort(-values, axis=1, kind='stable')
+        return np.take_along_axis(values, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+    def _gather(self, x, idx):
+        return np.take_along_axis(x, idx, axis=1)
+
+
+    def _masked_fill(self, x, mask, value):
+        return np.where(mask, value, x).astype(x.dtype)
+
+
+    def _nonzero(self, x):
+        return np.argwhere(x)
+
+
+def main():
+    '''
+    Usage: python ort_translate.py -model exported/model -vocab_pkl vocab.pkl -test_pkl test.pkl > pred.txt
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-model', required=True,
+                        help='Prefix of the files written by export_model.py -format onnx')
+    parser.add_argument('-vocab_pkl', required=True,
+                        help='Vocabulary written by nmt_preprocess.py -save_vocab')
+    parser.add_argument('-test_pkl', required=True,
+                        help='Test split written by nmt_preprocess.py -save_test')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=0)
+    parser.add_argument('-max_len_b', type=int, default=0)
+    parser.add_argument('-early_stop', action='store_true')
+    parser.add_argument('-batch_size', type=int, default=30)
+    parser.add_argument('-max_tokens', type=int, default=None,
+                        help='Padded source tokens per batch, sentences are sorted by length to fill it')
+    parser.add_argument('-n_threads', type=int, default=None)
+
+    opt = parser.parse_args()
+
+    src_vocab, trg_vocab, _ = load_vocab(opt.vocab_pkl)
+    translator = OrtTranslator(
+        opt.model, opt.beam_size, opt.max_seq_len,
+        max_len_a=opt.max_len_a, max_len_b=opt.max_len_b, early_stop=opt.early_stop, n_threads=opt.n_threads)
+
+    src_seqs = [src_vocab.encode(example['src']) for example in load_examples(opt.test_pkl)]
+    # Batch sentences of similar length together, write the predictions back in order.
+    pred_seqs = [None] * len(src_seqs)
+    for batch in token_budget_batches([len(seq) for seq in src_seqs], opt.max_tokens, opt.batch_size):
+        src_seq = np.array(pad_seqs([src_seqs[i] for i in batch], translator.src_pad_idx), dtype=np.int64)
+        for i, pred_seq in zip(batch, translator.translate_batch(src_seq)):
+            pred_seqs[i] = pred_seq
+
+    specials = {trg_vocab.init_token, trg_vocab.eos_token}
+    for pred_seq in pred_seqs:
+        print(' '.join(word for word in trg_vocab.decode(pred_seq) if word not in specials))
+    print('[Info] Finished.', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ from torchtext.datasets import TranslationDataset
 from torchtext.data import TabularDataset
 
 import transformer.Constants as Constants
+from vocab import Vocab, save_vocab
 from learn_bpe import learn_bpe
 from apply_bpe import BPE
 
@@ -257,6 +258,8 @@ def main_wo_bpe():
     parser.add_argument('-lang_src', choices=spacy_support_langs)
     parser.add_argument('-lang_trg', choices=spacy_support_langs)
     parser.add_argument('-save_data', required=True)
+    parser.add_argument('-save_vocab', default=None,
+                        help='Also write the vocabularies alone, e.g. for tm_translate.py -src_vocab_pkl')
     parser.add_argument('-data_type', type=str, default=None, choices=["gyafc", "korpora"])
     parser.add_argument('-data_dir', type=str, default=None, choices=[".data/gyafc", ".data/korpora"])
     parser.add_argument('-train_path', type=str, default="train.csv")
@@ -360,6 +363,10 @@ def main_wo_bpe():
     print('[Info] Dumping the processed data to pickle file', opt.save_data)
     pickle.dump(data, open(opt.save_data, 'wb'))
 
+    if opt.save_vocab:
+        print('[Info] Dumping the vocabulary to pickle file', opt.save_vocab)
+        save_vocab(opt.save_vocab, Vocab.from_field(SRC), Vocab.from_field(TRG), settings=vars(opt))
+
 
 if __name__ == '__main__':
     main_wo_bpe()
@@ -0,0 +1,135 @@
+''' Run translate_server.py in process on a Unix socket, with a stub in place of the model. '''
+import os
+import json
+import asyncio
+import argparse
+import tempfile
+
+import torch
+
+import transformer.Constants as Constants
+from translate_server import BatchingTranslator, serve
+from vocab import Vocab
+
+
+WORDS = ['a', 'b', 'c', 'd', 'boom']
+VOCAB = Vocab([Constants.UNK_WORD, Constants.PAD_WORD, Constants.BOS_WORD, Constants.EOS_WORD] + WORDS,
+              Constants.PAD_WORD, Constants.UNK_WORD, Constants.BOS_WORD, Constants.EOS_WORD)
+
+
+class StubTranslator(object):
+    ''' Translates a sentence into its words in reverse order, fails on the word boom. '''
+
+    src_pad_idx = VOCAB.pad_idx
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def translate_batch(self, src_seq):
+        self.batch_sizes.append(src_seq.size(0))
+        pred_seqs = []
+        for seq in src_seq.tolist():
+            if VOCAB.stoi['boom'] in seq:
+                raise RuntimeError('the model blew up')
+            pred_seqs.append([idx for idx in reversed(seq) if idx != self.src_pad_idx])
+        return pred_seqs
+
+
+async def request(path, method, url, payload=None):
+    reader, writer = await asyncio.open_unix_connection(path)
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(method, url, len(body)).encode('latin-1'))
+    writer.write(body)
+    await writer.drain()
+    status_line = await reader.readline()
+    response = await reader.read()
+    writer.close()
+    _, _, data = response.partition(b'\r\n\r\n')
+    return int(status_line.split()[1]), json.loads(data.decode('utf-8'))
+
+
+def run_with_server(client, batch_window=0.2, max_batch_size=30):
+    ''' Start the server, run client(path, translator, batcher) against it and return what it returns. '''
+    translator = StubTranslator()
+    batcher = BatchingTranslator(translator, VOCAB, VOCAB, str.split, torch.device('cpu'),
+                                 max_batch_size=max_batch_size, batch_window=batch_window)
+
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'server.sock')
+            server = asyncio.ensure_future(serve(batcher, argparse.Namespace(unix_socket=path)))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            try:
+                return await client(path, translator, batcher)
+            finally:
+                server.cancel()
+
+    return asyncio.run(main())
+
+
+def test_concurrent_requests_are_batched_in_order():
+    texts = ['a b', 'c', 'd c b a', 'b b c']
+
+    async def client(path, translator, batcher):
+        answers = await asyncio.gather(*[request(path, 'POST', '/translate', {'text': text}) for text in texts])
+        return answers, translator.batch_sizes
+
+    answers, batch_sizes = run_with_server(client)
+    assert batch_sizes == [len(texts)]
+    assert answers == [(200, {'translation': ' '.join(reversed(text.split()))}) for text in texts]
+
+
+def test_list_request_keeps_its_order():
+    texts = ['a b c', 'd', 'c a']
+
+    async def client(path, translator, batcher):
+        return await request(path, 'POST', '/translate', {'text': texts}), translator.batch_sizes
+
+    (status, payload), batch_sizes = run_with_server(client)
+    assert status == 200
+    assert payload['translation'] == [' '.join(reversed(text.split())) for text in texts]
+    assert batch_sizes == [len(texts)]
+
+
+def test_batches_are_capped():
+    async def client(path, translator, batcher):
+        await asyncio.gather(*[request(path, 'POST', '/translate', {'text': 'a'}) for _ in range(5)])
+        return translator.batch_sizes
+
+    assert sorted(run_with_server(client, max_batch_size=2)) == [1, 2, 2]
+
+
+def test_failed_sentence_returns_500():
+    async def client(path, translator, batcher):
+        answers = await asyncio.gather(
+            request(path, 'POST', '/translate', {'text': 'a boom'}),
+            request(path, 'POST', '/translate', {'text': 'a b'}))
+        # The server keeps serving after the failure.
+        answers.append(await request(path, 'POST', '/translate', {'text': 'c d'}))
+        return answers, translator.batch_sizes
+
+    ((status, payload), other, after), batch_sizes = run_with_server(client)
+    assert status == 500
+    assert 'the model blew up' in payload['error']
+    # The failed batch is decoded again one sentence at a time, the other sentence still gets through.
+    assert other == (200, {'translation': 'b a'})
+    assert after == (200, {'translation': 'd c'})
+    assert batch_sizes == [2, 1, 1, 1]
+
+
+def test_bad_requests():
+    async def client(path, translator, batcher):
+        return [
+            await request(path, 'POST', '/translate', {'txt': 'a'}),
+            await request(path, 'POST', '/translate', {'text': 5}),
+            await request(path, 'POST', '/translate', ['a']),
+            await request(path, 'POST', '/translate', {'text': ['a', 5]}),
+            await request(path, 'GET', '/nothing'),
+            await request(path, 'GET', '/stats')]
+
+    *malformed, unknown, stats = run_with_server(client, batch_window=0)
+    assert [status for status, _ in malformed] == [400] * 4
+    assert all('error' in payload for _, payload in malformed)
+    assert unknown[0] == 404
+    assert stats[0] == 200 and stats[1]['n_sentences'] == 0
@@ -9,9 +9,11 @@ from torch import nn
 import sentencepiece as spm
 
 import transformer.Constants as Constants
-from torchtext.data import Dataset
 from transformer.TM_Models import Transformer, VAETransformer, NMTEncoder
 from transformer.Translator import Translator
+from transformer.Quantization import quantize_dynamic_int8
+from transformer.Batching import token_budget_batches, pad_seqs
+from vocab import Vocab, load_vocab, load_examples
 
 
 def load_model(opt, device):
@@ -98,8 +100,6 @@ def load_model(opt, device):
         return model
 
 
-
-
 def main():
     '''Main Function'''
 
@@ -107,73 +107,123 @@ def main():
 
     parser.add_argument('-model', required=True,
                         help='Path to model weight file')
-    parser.add_argument('-data_pkl', required=True,
+    parser.add_argument('-data_pkl', default=None,
                         help='Pickle file with both instances and vocabulary.')
+    parser.add_argument('-vocab_pkl', default=None,
+                        help='Vocabulary written by nmt_preprocess.py -save_vocab, used instead of -data_pkl')
+    parser.add_argument('-test_pkl', default=None,
+                        help='Test split written by nmt_preprocess.py -save_test, goes with -vocab_pkl')
     parser.add_argument('-output', default='output/pred_text',
                         help="""Path to output the predictions (each line will
                         be the decoded sequence""")
     parser.add_argument('-file_name', default=None)
+    parser.add_argument('-src_vocab_pkl', default='.data/pkl/gyafc_spm_bpe.vocab.pkl',
+                        help='Source vocabulary of the style transfer data, written by preprocess.py -save_vocab '
+                             '(a full data pickle works too, but takes as long to load as the whole dataset)')
     parser.add_argument('-beam_size', type=int, default=5)
     parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=0,
+                        help='Decode up to max_len_a * source length + max_len_b tokens, capped by max_seq_len')
+    parser.add_argument('-max_len_b', type=int, default=0)
+    parser.add_argument('-early_stop', action='store_true',
+                        help='Stop a sentence once no beam can beat its best finished hypothesis')
     parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-quantize', action='store_true',
+                        help='Dynamic int8 quantization of the attention, feed forward and output layers (CPU only)')
     parser.add_argument('-variational', action='store_true')
     parser.add_argument('-split', action='store_true')
     parser.add_argument('-task_type', type=str, default=None, choices=["tst", "nmt"])
+    parser.add_argument('-n_samples', type=int, default=None,
+                        help='Write this many outputs per sentence, decoded from latent samples (with -variational)')
 
     # TODO: Translate bpe encoded files 
     #parser.add_argument('-src', required=True,
     #                    help='Source sequence to decode (one line per sequence)')
     #parser.add_argument('-vocab', required=True,
     #                    help='Source sequence to decode (one line per sequence)')
-    # TODO: Batch translation
     parser.add_argument('-batch_size', type=int, default=30,
-                       help='Batch size')
+                        help='Batch size')
+    parser.add_argument('-max_tokens', type=int, default=None,
+                        help='Padded source tokens per batch, sentences are sorted by length to fill it')
     #parser.add_argument('-n_best', type=int, default=1,
     #                    help="""If verbose is set, will output the n_best
     #                    decoded sentences""")
 
     opt = parser.parse_args()
     opt.cuda = not opt.no_cuda
+    if opt.quantize and opt.cuda:
+        parser.error('-quantize runs on CPU only, add -no_cuda')
+    if opt.n_samples and not opt.variational:
+        parser.error('-n_samples needs a -variational model')
+    if not (opt.data_pkl or opt.vocab_pkl):
+        parser.error('One of -data_pkl or -vocab_pkl is needed')
+
+    if opt.vocab_pkl:
+        if not opt.test_pkl:
+            parser.error('-vocab_pkl needs -test_pkl')
+        _, trg_vocab, _ = load_vocab(opt.vocab_pkl)
+        test_examples = load_examples(opt.test_pkl)
+    else:
+        data = pickle.load(open(opt.data_pkl, 'rb'))
+        trg_vocab = Vocab.from_field(data['vocab']['trg'])
+        test_examples = [{'src': example.src, 'trg': example.trg} for example in data['test']]
+
+    tst_data = pickle.load(open(opt.src_vocab_pkl, 'rb'))
+    if 'vocab' in tst_data:
+        # A full data pickle of the style transfer task.
+        src_vocab = Vocab.from_field(tst_data['vocab']['src'])
+    else:
+        src_vocab = Vocab(**tst_data['src'])
 
-    data = pickle.load(open(opt.data_pkl, 'rb'))
-    tst_data = pickle.load(open(".data/pkl/gyafc_spm_bpe.pkl", "rb"))
-    SRC = tst_data['vocab']['src']
-    TRG = data['vocab']['trg']
-    # print("SRC", )
-    opt.src_pad_idx = SRC.vocab.stoi[Constants.PAD_WORD]
-    opt.trg_pad_idx = TRG.vocab.stoi[Constants.PAD_WORD]
-    opt.trg_bos_idx = TRG.vocab.stoi[Constants.BOS_WORD]
-    opt.trg_eos_idx = TRG.vocab.stoi[Constants.EOS_WORD]
+    opt.src_pad_idx = src_vocab.stoi[Constants.PAD_WORD]
+    opt.trg_pad_idx = trg_vocab.stoi[Constants.PAD_WORD]
+    opt.trg_bos_idx = trg_vocab.stoi[Constants.BOS_WORD]
+    opt.trg_eos_idx = trg_vocab.stoi[Constants.EOS_WORD]
     # print("opt.src_pad_idx", opt.src_pad_idx) 1
     # print("opt.trg_pad_idx", opt.trg_pad_idx) 1
     # print("opt.trg_bos_idx", opt.trg_bos_idx) 2
     # print("opt.trg_eos_idx", opt.trg_eos_idx) 3
 
-    test_loader = Dataset(examples=data['test'], fields={'src': SRC, 'trg': TRG})
-    
     device = torch.device('cuda' if opt.cuda else 'cpu')
-    checkpoint = torch.load(opt.model, map_location=device)
-    model_opt = checkpoint['settings']
+    model = load_model(opt, device)
+    if opt.quantize:
+        model = quantize_dynamic_int8(model)
     translator = Translator(opt,
-        model=load_model(opt, device),
-        src_vocab_size = model_opt.src_vocab_size,
-        d_word_vec = model_opt.d_word_vec,
+        model=model,
         beam_size=opt.beam_size,
         max_seq_len=opt.max_seq_len,
         src_pad_idx=opt.src_pad_idx,
         trg_pad_idx=opt.trg_pad_idx,
         trg_bos_idx=opt.trg_bos_idx,
-        trg_eos_idx=opt.trg_eos_idx).to(device)
-
-    unk_idx = SRC.vocab.stoi[SRC.unk_token]
+        trg_eos_idx=opt.trg_eos_idx,
+        max_len_a=opt.max_len_a,
+        max_len_b=opt.max_len_b,
+        early_stop=opt.early_stop).to(device)
+
+    src_seqs = [src_vocab.encode(example['src']) for example in test_examples]
+    batches = token_budget_batches([len(seq) for seq in src_seqs], opt.max_tokens, opt.batch_size)
+
+    pred_lines = [None] * len(src_seqs)
+    for batch in tqdm(batches, mininterval=2, desc='  - (Test)', leave=False):
+        src_seq = torch.LongTensor(pad_seqs([src_seqs[i] for i in batch], opt.src_pad_idx)).to(device)
+        if opt.n_samples:
+            # The samples of a sentence go on consecutive lines, best scored first.
+            samples = translator.sample_batch(src_seq, opt.n_samples)
+            pred_seqs = [[pred_seq for pred_seq, _ in sent_samples] for sent_samples in samples]
+        else:
+            pred_seqs = [[pred_seq] for pred_seq in translator.translate_batch(src_seq)]
+        for i, sent_pred_seqs in zip(batch, pred_seqs):
+            sent_lines = []
+            for pred_seq in sent_pred_seqs:
+                pred_line = ' '.join(trg_vocab.decode(pred_seq))
+                pred_line = pred_line.replace(Constants.BOS_WORD, '').replace(Constants.EOS_WORD, '')
+                sent_lines.append(pred_line.strip())
+            pred_lines[i] = '\n'.join(sent_lines)
+
+    # Batches run in length order, write the predictions back in the order of the test set.
     with open(os.path.join(opt.output, opt.file_name), 'w') as f:
-        for example in tqdm(test_loader, mininterval=2, desc='  - (Test)', leave=False):
-            src_seq = [SRC.vocab.stoi.get(word, unk_idx) for word in example.src]
-            # print("src_seq", src_seq)
-            pred_seq = translator.translate_sentence(torch.LongTensor([src_seq]).to(device))
-            pred_line = ' '.join(TRG.vocab.itos[idx] for idx in pred_seq)
-            pred_line = pred_line.replace(Constants.BOS_WORD, '').replace(Constants.EOS_WORD, '')
-            f.write(pred_line.strip() + '\n')
+        for pred_line in pred_lines:
+            f.write(pred_line + '\n')
 
     print('[Info] Finished.')
 
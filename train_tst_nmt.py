@@ -285,6 +285,9 @@ def main():
 
     parser.add_argument('-no_cuda', action='store_true')
     parser.add_argument('-label_smoothing', action='store_true')
+    parser.add_argument('-checkpoint_every', type=int, default=0,
+                        help='Recompute the activations of every k-th encoder/decoder layer in the backward pass, '
+                             'trading about a third more step time at 1 for keeping only the layer inputs')
 
     opt = parser.parse_args()
     opt.cuda = not opt.no_cuda
@@ -378,7 +381,8 @@ def main():
             n_layers=opt.n_layers,
             n_head=opt.n_head,
             dropout=opt.dropout,
-            scale_emb_or_prj=opt.scale_emb_or_prj).to(device)
+            scale_emb_or_prj=opt.scale_emb_or_prj,
+            checkpoint_every=opt.checkpoint_every).to(device)
         # transformer.load_state_dict(torch.load("output/vae/model.chkpt")['model'])
         # transformer = nn.DataParallel(transformer).to(device)
 
@@ -399,7 +403,8 @@ def main():
             n_layers=opt.n_layers,
             n_head=opt.n_head,
             dropout=opt.dropout,
-            scale_emb_or_prj=opt.scale_emb_or_prj).to(device)
+            scale_emb_or_prj=opt.scale_emb_or_prj,
+            checkpoint_every=opt.checkpoint_every).to(device)
         # transformer = nn.DataParallel(transformer).to(device)
 
     # optimizer = ScheduledOptim(
@@ -195,12 +195,16 @@ def train(model, training_data, validation_data, optimizer, lr_scheduler, device
             print('[ Epoch', epoch_i, ']')
 
         start = time.time()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
         train_loss, train_accu = train_epoch(
             model, training_data, optimizer, lr_scheduler, opt, epoch_i, device, smoothing=opt.label_smoothing)
         train_ppl = math.exp(min(train_loss, 100))
         # Current learning rate
         lr = optimizer.param_groups[0]['lr']
         print_performances('Training', train_ppl, train_accu, train_loss, start, lr)
+        if device.type == 'cuda':
+            print(f'  - {"Peak memory":12} {torch.cuda.max_memory_allocated(device) / 2 ** 20:.1f} MiB')
 
         start = time.time()
         valid_loss, valid_accu = eval_epoch(model, validation_data, epoch_i, device, opt)
@@ -286,6 +290,9 @@ def main():
 
     parser.add_argument('-no_cuda', action='store_true')
     parser.add_argument('-label_smoothing', action='store_true')
+    parser.add_argument('-checkpoint_every', type=int, default=0,
+                        help='Recompute the activations of every k-th encoder/decoder layer in the backward pass, '
+                             'trading about a third more step time at 1 for keeping only the layer inputs')
 
     opt = parser.parse_args()
     opt.cuda = not opt.no_cuda
@@ -348,7 +355,8 @@ def main():
             n_layers=opt.n_layers,
             n_head=opt.n_head,
             dropout=opt.dropout,
-            scale_emb_or_prj=opt.scale_emb_or_prj).to(device)
+            scale_emb_or_prj=opt.scale_emb_or_prj,
+            checkpoint_every=opt.checkpoint_every).to(device)
         # transformer.load_state_dict(torch.load("output/vae/model.chkpt")['model'])
         # transformer = nn.DataParallel(transformer).to(device)
 
@@ -369,7 +377,8 @@ def main():
             n_layers=opt.n_layers,
             n_head=opt.n_head,
             dropout=opt.dropout,
-            scale_emb_or_prj=opt.scale_emb_or_prj).to(device)
+            scale_emb_or_prj=opt.scale_emb_or_prj,
+            checkpoint_every=opt.checkpoint_every).to(device)
         # transformer = nn.DataParallel(transformer).to(device)
 
     # optimizer = ScheduledOptim(
@@ -0,0 +1,30 @@
+''' Group test sentences into length-sorted batches for decoding. '''
+
+
+def token_budget_batches(seq_lens, max_tokens=None, max_batch_size=None):
+    '''
+    Sort the sentences by length and pack them into batches whose padded size,
+    batch size * longest length, stays within max_tokens.
+    Returns lists of the original positions, one list per batch.
+    '''
+
+    order = sorted(range(len(seq_lens)), key=lambda i: seq_lens[i])
+
+    batches, batch = [], []
+    for i in order:
+        # Sorted ascending, so the incoming sentence is the longest of the batch.
+        n_tokens = (len(batch) + 1) * seq_lens[i]
+        if batch and ((max_tokens and n_tokens > max_tokens)
+                      or (max_batch_size and len(batch) >= max_batch_size)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def pad_seqs(seqs, pad_idx):
+    ''' Pad the id lists to the length of the longest one. '''
+    max_len = max(len(seq) for seq in seqs)
+    return [seq + [pad_idx] * (max_len - len(seq)) for seq in seqs]
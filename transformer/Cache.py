@@ -0,0 +1,111 @@
+''' Memoize translations of repeated sources in front of a Translator. '''
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+def checkpoint_identity(path, chunk_size=1 << 20):
+    ''' Digest of the checkpoint file, so a retrained model never reuses old translations. '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class TranslationCache(object):
+    '''
+    A bounded LRU cache of translations, keyed on the source token ids, the task type,
+    the decoding settings, the checkpoint and its numeric mode (see Quantization.numeric_mode).
+    A hit never touches the model.
+    '''
+
+    def __init__(self, translator, checkpoint_id, numeric_mode, max_size=100000, path=None):
+        self.translator = translator
+        self.max_size = max_size
+        self.path = path
+        self.n_hits = 0
+        self.n_misses = 0
+
+        t = translator
+        self.settings = (
+            checkpoint_id, numeric_mode, getattr(t.opt, 'task_type', None), t.beam_size, t.alpha,
+            t.max_seq_len, t.max_len_a, t.max_len_b, t.early_stop,
+            t.shortlist.path if t.shortlist is not None else None)
+
+        self.entries = OrderedDict()
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.entries = pickle.load(f)
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    @property
+    def src_pad_idx(self):
+        return self.translator.src_pad_idx
+
+    def _key(self, src_ids):
+        return self.settings + tuple(idx for idx in src_ids if idx != self.src_pad_idx)
+
+    def get(self, src_ids):
+        ''' The cached translation of src_ids, or None. '''
+        key = self._key(src_ids)
+        pred_seq = self.entries.get(key)
+        if pred_seq is None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        self.entries.move_to_end(key)
+        return pred_seq
+
+    def put(self, src_ids, pred_seq):
+        key = self._key(src_ids)
+        self.entries[key] = pred_seq
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def translate_batch(self, src_seq):
+        '''
+        Same as Translator.translate_batch, only the missed rows reach the model,
+        each distinct source once however often it repeats in the batch.
+        '''
+        src_rows = src_seq.tolist()
+        pred_seqs = [None] * len(src_rows)
+        # -- key of a missed source -> the rows holding it
+        missed = OrderedDict()
+        for i, src_ids in enumerate(src_rows):
+            key = self._key(src_ids)
+            if key in missed:
+                # A repeat of a source missed earlier in the batch, it comes along with that one.
+                self.n_hits += 1
+                missed[key].append(i)
+                continue
+            pred_seqs[i] = self.get(src_ids)
+            if pred_seqs[i] is None:
+                missed[key] = [i]
+
+        if missed:
+            missed_seq = src_seq[torch.tensor([rows[0] for rows in missed.values()], device=src_seq.device)]
+            for rows, pred_seq in zip(missed.values(), self.translator.translate_batch(missed_seq)):
+                self.put(src_rows[rows[0]], pred_seq)
+                for i in rows:
+                    pred_seqs[i] = pred_seq
+        return pred_seqs
+
+    def save(self):
+        ''' Write the entries to path, loaded back on the next start. '''
+        if self.path:
+            with open(self.path, 'wb') as f:
+                pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def stats(self):
+        n_lookups = self.n_hits + self.n_misses
+        return {
+            'cache_size': len(self.entries),
+            'cache_hits': self.n_hits,
+            'cache_misses': self.n_misses,
+            'cache_hit_rate': self.n_hits / n_lookups if n_lookups else None}
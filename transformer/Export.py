@@ -0,0 +1,156 @@
+''' Wrap a Translator's model into an encoder and a single decoding step, to be compiled. '''
+import json
+import inspect
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformer.TM_Models import get_pad_mask
+
+
+class EncoderExport(nn.Module):
+    '''
+    Source ids -> the keys/values every decoder layer attends to,
+    stacked over the layers: n_layers x b x n x l x d.
+    '''
+
+    def __init__(self, translator):
+        super().__init__()
+        self.translator = translator
+
+    def forward(self, src_seq):
+        translator = self.translator
+        src_mask = get_pad_mask(src_seq, translator.src_pad_idx)
+        enc_output = translator._model_encode(src_seq, src_mask)
+        cache = translator._get_decoder().init_cache(enc_output)
+        enc_k = torch.stack([layer_cache['enc_attn']['k'] for layer_cache in cache])
+        enc_v = torch.stack([layer_cache['enc_attn']['v'] for layer_cache in cache])
+        return enc_k, enc_v
+
+
+class DecoderStepExport(nn.Module):
+    '''
+    One decoding step over stacked caches, without any Python state:
+    (words, step, src_mask, enc_k, enc_v, slf_k, slf_v) -> (log_probs, slf_k, slf_v)
+    where words holds the newest word of each row, step their position as a 1 element tensor,
+    and slf_k/slf_v the self attention keys/values of the earlier steps, n_layers x rows x n x step x d.
+    '''
+
+    def __init__(self, translator):
+        super().__init__()
+        self.decoder = translator._get_decoder()
+        self.trg_word_prj = translator.model.trg_word_prj
+
+    def forward(self, words, step, src_mask, enc_k, enc_v, slf_k, slf_v):
+        decoder = self.decoder
+
+        dec_output = decoder.trg_word_emb(words).unsqueeze(1)
+        if decoder.scale_emb:
+            dec_output = dec_output * decoder.d_model ** 0.5
+        # The position comes in as a tensor so that it is not frozen into the graph.
+        dec_output = dec_output + decoder.position_enc.encode(step)
+        dec_output = decoder.layer_norm(dec_output)
+
+        slf_k_list, slf_v_list = [], []
+        for i, dec_layer in enumerate(decoder.layer_stack):
+            slf_attn_cache = {'k': slf_k[i], 'v': slf_v[i]}
+            dec_output, _ = dec_layer.slf_attn(dec_output, dec_output, dec_output, cache=slf_attn_cache)
+            slf_k_list.append(slf_attn_cache['k'])
+            slf_v_list.append(slf_attn_cache['v'])
+            dec_output, _ = dec_layer.enc_attn(
+                dec_output, None, None, mask=src_mask, cache={'k': enc_k[i], 'v': enc_v[i]})
+            dec_output = dec_layer.pos_ffn(dec_output)
+
+        log_probs = F.log_softmax(self.trg_word_prj(dec_output[:, -1]), dim=-1)
+        return log_probs, torch.stack(slf_k_list), torch.stack(slf_v_list)
+
+
+def get_example_inputs(translator, beam_size=2, src_len=5, device=None):
+    ''' A small batch of 2 sentences to trace with, every size is kept symbolic in the graph. '''
+    decoder = translator._get_decoder()
+    n_layers = len(decoder.layer_stack)
+    slf_attn = decoder.layer_stack[0].slf_attn
+    n_rows = 2 * beam_size
+
+    # Any word that is not padding will do.
+    src_seq = torch.full((2, src_len), translator.trg_eos_idx, dtype=torch.long, device=device)
+    src_seq[1, -1] = translator.src_pad_idx
+    words = torch.full((n_rows,), translator.trg_bos_idx, dtype=torch.long, device=device)
+    step = torch.ones(1, dtype=torch.long, device=device)
+    slf_k = torch.zeros(n_layers, n_rows, slf_attn.n_head, 1, slf_attn.d_k, device=device)
+    slf_v = torch.zeros(n_layers, n_rows, slf_attn.n_head, 1, slf_attn.d_v, device=device)
+    return src_seq, words, step, slf_k, slf_v
+
+
+def get_metadata(translator):
+    ''' What a translator needs besides the compiled graphs. '''
+    return {
+        'src_pad_idx': translator.src_pad_idx,
+        'trg_pad_idx': translator.trg_pad_idx,
+        'trg_bos_idx': translator.trg_bos_idx,
+        'trg_eos_idx': translator.trg_eos_idx,
+        'task_type': getattr(translator.opt, 'task_type', None)}
+
+
+def export_torchscript(translator, prefix):
+    '''
+    Trace the encoder and the decoding step of translator into
+    prefix.encoder.pt and prefix.decoder_step.pt, see CompiledTranslator.
+    '''
+    translator.eval()
+    device = next(translator.model.parameters()).device
+    src_seq, words, step, slf_k, slf_v = get_example_inputs(translator, device=device)
+    src_mask = get_pad_mask(src_seq, translator.src_pad_idx)
+
+    encoder, decoder_step = EncoderExport(translator), DecoderStepExport(translator)
+    with torch.no_grad():
+        enc_k, enc_v = encoder(src_seq)
+        encoder = torch.jit.trace(encoder, (src_seq,))
+        decoder_step = torch.jit.trace(decoder_step, (words, step, src_mask, enc_k, enc_v, slf_k, slf_v))
+
+    encoder.save(prefix + '.encoder.pt')
+    decoder_step.save(prefix + '.decoder_step.pt')
+    with open(prefix + '.json', 'w') as f:
+        json.dump(get_metadata(translator), f, indent=2)
+
+
+def export_onnx(translator, prefix, opset_version=14):
+    '''
+    Export the encoder and the decoding step of translator into prefix.encoder.onnx and
+    prefix.decoder_step.onnx, the batch, lengths and steps stay dynamic. See ort_translate.py.
+    '''
+    translator.eval()
+    device = next(translator.model.parameters()).device
+    src_seq, words, step, slf_k, slf_v = get_example_inputs(translator, device=device)
+    src_mask = get_pad_mask(src_seq, translator.src_pad_idx)
+
+    encoder, decoder_step = EncoderExport(translator), DecoderStepExport(translator)
+    # The graphs are traced with dynamic_axes, newer torch defaults to the dynamo exporter instead.
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        enc_k, enc_v = encoder(src_seq)
+        torch.onnx.export(
+            encoder, (src_seq,), prefix + '.encoder.onnx', opset_version=opset_version, **kwargs,
+            input_names=['src_seq'], output_names=['enc_k', 'enc_v'],
+            dynamic_axes={
+                'src_seq': {0: 'batch', 1: 'src_len'},
+                'enc_k': {1: 'batch', 3: 'src_len'},
+                'enc_v': {1: 'batch', 3: 'src_len'}})
+        torch.onnx.export(
+            decoder_step, (words, step, src_mask, enc_k, enc_v, slf_k, slf_v),
+            prefix + '.decoder_step.onnx', opset_version=opset_version, **kwargs,
+            input_names=['words', 'step', 'src_mask', 'enc_k', 'enc_v', 'slf_k', 'slf_v'],
+            output_names=['log_probs', 'new_slf_k', 'new_slf_v'],
+            dynamic_axes={
+                'words': {0: 'rows'},
+                'src_mask': {0: 'batch', 2: 'src_len'},
+                'enc_k': {1: 'batch', 3: 'src_len'},
+                'enc_v': {1: 'batch', 3: 'src_len'},
+                'slf_k': {1: 'rows', 3: 'n_steps'},
+                'slf_v': {1: 'rows', 3: 'n_steps'},
+                'log_probs': {0: 'rows'},
+                'new_slf_k': {1: 'rows', 3: 'n_steps_next'},
+                'new_slf_v': {1: 'rows', 3: 'n_steps_next'}})
+
+    with open(prefix + '.json', 'w') as f:
+        json.dump(get_metadata(translator), f, indent=2)
@@ -1,8 +1,8 @@
 ''' Define the Transformer model '''
 import torch
 import torch.nn as nn
-import numpy as np
-from transformer.Layers import EncoderLayer, DecoderLayer
+from transformer.Layers import EncoderLayer, DecoderLayer, is_checkpointed, run_checkpointed
+from transformer.Modules import PositionalEncoding, get_causal_mask, get_trg_mask
 
 
 __author__ = "Yu-Hsiang Huang"
@@ -13,36 +13,9 @@ def get_pad_mask(seq, pad_idx):
 
 
 def get_subsequent_mask(seq):
-    ''' For masking out the subsequent info. '''
+    ''' For masking out the subsequent info, a view of the mask cached for seq.device. '''
     sz_b, len_s = seq.size()
-    subsequent_mask = (1 - torch.triu(
-        torch.ones((1, len_s, len_s), device=seq.device), diagonal=1)).bool()
-    return subsequent_mask
-
-
-class PositionalEncoding(nn.Module):
-
-    def __init__(self, d_hid, n_position=200):
-        super(PositionalEncoding, self).__init__()
-
-        # Not a parameter
-        self.register_buffer('pos_table', self._get_sinusoid_encoding_table(n_position, d_hid))
-
-    def _get_sinusoid_encoding_table(self, n_position, d_hid):
-        ''' Sinusoid position encoding table '''
-        # TODO: make it with torch instead of numpy
-
-        def get_position_angle_vec(position):
-            return [position / np.power(10000, 2 * (hid_j // 2) / d_hid) for hid_j in range(d_hid)]
-
-        sinusoid_table = np.array([get_position_angle_vec(pos_i) for pos_i in range(n_position)])
-        sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
-        sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
-
-        return torch.FloatTensor(sinusoid_table).unsqueeze(0)
-
-    def forward(self, x):
-        return x + self.pos_table[:, :x.size(1)].clone().detach()
+    return get_causal_mask(len_s, seq.device)
 
 
 class Encoder(nn.Module):
@@ -50,7 +23,7 @@ class Encoder(nn.Module):
 
     def __init__(
             self, n_src_vocab, d_word_vec, n_layers, n_head, d_k, d_v,
-            d_model, d_inner, pad_idx, dropout=0.1, n_position=200, scale_emb=False):
+            d_model, d_inner, pad_idx, dropout=0.1, n_position=200, scale_emb=False, checkpoint_every=0):
 
         super().__init__()
 
@@ -63,6 +36,8 @@ class Encoder(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.scale_emb = scale_emb
         self.d_model = d_model
+        # -- 0 or k: the activations of every k-th layer get recomputed in the backward pass
+        self.checkpoint_every = checkpoint_every
 
     def forward(self, src_seq, src_mask, return_attns=False):
 
@@ -75,8 +50,12 @@ class Encoder(nn.Module):
         enc_output = self.dropout(self.position_enc(enc_output))
         enc_output = self.layer_norm(enc_output)
 
-        for enc_layer in self.layer_stack:
-            enc_output, enc_slf_attn = enc_layer(enc_output, slf_attn_mask=src_mask)
+        for i, enc_layer in enumerate(self.layer_stack):
+            if is_checkpointed(i, self.checkpoint_every, self):
+                enc_output, enc_slf_attn = run_checkpointed(
+                    enc_layer, enc_output, slf_attn_mask=src_mask, need_weights=return_attns)
+            else:
+                enc_output, enc_slf_attn = enc_layer(enc_output, slf_attn_mask=src_mask, need_weights=return_attns)
             enc_slf_attn_list += [enc_slf_attn] if return_attns else []
 
         if return_attns:
@@ -89,7 +68,7 @@ class Decoder(nn.Module):
 
     def __init__(
             self, n_trg_vocab, d_word_vec, n_layers, n_head, d_k, d_v,
-            d_model, d_inner, pad_idx, n_position=200, dropout=0.1, scale_emb=False):
+            d_model, d_inner, pad_idx, n_position=200, dropout=0.1, scale_emb=False, checkpoint_every=0):
 
         super().__init__()
 
@@ -102,62 +81,56 @@ class Decoder(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.scale_emb = scale_emb
         self.d_model = d_model
-
-    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False):
+        # -- 0 or k: the activations of every k-th layer get recomputed in the backward pass
+        self.checkpoint_every = checkpoint_every
+
+    def init_cache(self, enc_output=None):
+        ''' Per-layer key/value caches for incremental decoding. '''
+        cache = [{} for _ in self.layer_stack]
+        if enc_output is not None:
+            # The encoder output is fixed while decoding, project it for every layer only once.
+            for layer_cache, dec_layer in zip(cache, self.layer_stack):
+                enc_k, enc_v = dec_layer.enc_attn.project_kv(enc_output, enc_output)
+                layer_cache['enc_attn'] = {'k': enc_k, 'v': enc_v}
+        return cache
+
+    def reorder_cache(self, cache, beam_idx, enc_idx=None):
+        ''' Move the cached keys/values along with their beams, keep the enc_idx rows of the encoder ones. '''
+        for layer_cache in cache:
+            for name, idx in (('slf_attn', beam_idx), ('enc_attn', enc_idx)):
+                if idx is None or name not in layer_cache:
+                    continue
+                attn_cache = layer_cache[name]
+                for key, value in attn_cache.items():
+                    attn_cache[key] = value.index_select(0, idx)
+
+    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False, cache=None, is_causal=False):
+        '''
+        With is_causal, trg_mask is None and every position only attends to the earlier ones,
+        which the attention kernel gets as a flag rather than as a mask tensor (see get_trg_mask).
+        '''
 
         dec_slf_attn_list, dec_enc_attn_list = [], []
 
-        # -- Forward
-        dec_output = self.trg_word_emb(trg_seq)
-        if self.scale_emb:
-            dec_output *= self.d_model ** 0.5
-        dec_output = self.dropout(self.position_enc(dec_output))
-        dec_output = self.layer_norm(dec_output)
-
-        for dec_layer in self.layer_stack:
-            dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
-                dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask)
-            dec_slf_attn_list += [dec_slf_attn] if return_attns else []
-            dec_enc_attn_list += [dec_enc_attn] if return_attns else []
-
-        if return_attns:
-            return dec_output, dec_slf_attn_list, dec_enc_attn_list
-        return dec_output,
-
-
-class TSTDecoder(nn.Module):
-    ''' A decoder model with self attention mechanism. '''
-
-    def __init__(
-            self, n_trg_vocab, d_word_vec, n_layers, n_head, d_k, d_v,
-            d_model, d_inner, pad_idx, n_position=200, dropout=0.1, scale_emb=False):
-
-        super().__init__()
-
-        self.trg_word_emb = nn.Embedding(n_trg_vocab, d_word_vec, padding_idx=pad_idx)
-        self.position_enc = PositionalEncoding(d_word_vec, n_position=n_position)
-        self.dropout = nn.Dropout(p=dropout)
-        self.layer_stack = nn.ModuleList([
-            DecoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
-            for _ in range(n_layers)])
-        self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
-        self.scale_emb = scale_emb
-        self.d_model = d_model
-
-    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False):
-
-        dec_slf_attn_list, dec_enc_attn_list = [], []
+        # With a cache, trg_seq only holds the newest tokens, the earlier ones are in the cache.
+        start = cache[0]['slf_attn']['k'].size(2) if cache and 'slf_attn' in cache[0] else 0
 
         # -- Forward
         dec_output = self.trg_word_emb(trg_seq)
         if self.scale_emb:
             dec_output *= self.d_model ** 0.5
-        dec_output = self.dropout(self.position_enc(dec_output))
+        dec_output = self.dropout(self.position_enc(dec_output, start))
         dec_output = self.layer_norm(dec_output)
 
-        for dec_layer in self.layer_stack:
-            dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
-                dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask)
+        for i, dec_layer in enumerate(self.layer_stack):
+            if cache is None and is_checkpointed(i, self.checkpoint_every, self):
+                dec_output, dec_slf_attn, dec_enc_attn = run_checkpointed(
+                    dec_layer, dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask,
+                    need_weights=return_attns, is_causal=is_causal)
+            else:
+                dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
+                    dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask,
+                    cache=None if cache is None else cache[i], need_weights=return_attns, is_causal=is_causal)
             dec_slf_attn_list += [dec_slf_attn] if return_attns else []
             dec_enc_attn_list += [dec_enc_attn] if return_attns else []
 
@@ -166,45 +139,12 @@ class TSTDecoder(nn.Module):
         return dec_output,
 
 
-class NMTDecoder(nn.Module):
-    ''' A decoder model with self attention mechanism. '''
-
-    def __init__(
-            self, n_trg_vocab, d_word_vec, n_layers, n_head, d_k, d_v,
-            d_model, d_inner, pad_idx, n_position=200, dropout=0.1, scale_emb=False):
-
-        super().__init__()
-
-        self.trg_word_emb = nn.Embedding(n_trg_vocab, d_word_vec, padding_idx=pad_idx)
-        self.position_enc = PositionalEncoding(d_word_vec, n_position=n_position)
-        self.dropout = nn.Dropout(p=dropout)
-        self.layer_stack = nn.ModuleList([
-            DecoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
-            for _ in range(n_layers)])
-        self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
-        self.scale_emb = scale_emb
-        self.d_model = d_model
-
-    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False):
-
-        dec_slf_attn_list, dec_enc_attn_list = [], []
-
-        # -- Forward
-        dec_output = self.trg_word_emb(trg_seq)
-        if self.scale_emb:
-            dec_output *= self.d_model ** 0.5
-        dec_output = self.dropout(self.position_enc(dec_output))
-        dec_output = self.layer_norm(dec_output)
+class TSTDecoder(Decoder):
+    ''' The decoder head of the style transfer task. '''
 
-        for dec_layer in self.layer_stack:
-            dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
-                dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask)
-            dec_slf_attn_list += [dec_slf_attn] if return_attns else []
-            dec_enc_attn_list += [dec_enc_attn] if return_attns else []
 
-        if return_attns:
-            return dec_output, dec_slf_attn_list, dec_enc_attn_list
-        return dec_output,
+class NMTDecoder(Decoder):
+    ''' The decoder head of the translation task. '''
 
 
 class Transformer(nn.Module):
@@ -215,7 +155,7 @@ class Transformer(nn.Module):
             d_word_vec=512, d_model=512, d_inner=2048,
             n_layers=6, n_head=8, d_k=64, d_v=64, dropout=0.1, n_position=200,
             trg_emb_prj_weight_sharing=True, emb_src_trg_weight_sharing=True,
-            scale_emb_or_prj='prj'):
+            scale_emb_or_prj='prj', checkpoint_every=0):
 
         super().__init__()
 
@@ -240,13 +180,15 @@ class Transformer(nn.Module):
             n_src_vocab=n_src_vocab, n_position=n_position,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
             n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            pad_idx=src_pad_idx, dropout=dropout, scale_emb=scale_emb)
+            pad_idx=src_pad_idx, dropout=dropout, scale_emb=scale_emb,
+            checkpoint_every=checkpoint_every)
 
         self.decoder = Decoder(
             n_trg_vocab=n_trg_vocab, n_position=n_position,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
             n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            pad_idx=trg_pad_idx, dropout=dropout, scale_emb=scale_emb)
+            pad_idx=trg_pad_idx, dropout=dropout, scale_emb=scale_emb,
+            checkpoint_every=checkpoint_every)
 
         self.trg_word_prj = nn.Linear(d_model, n_trg_vocab, bias=False)
 
@@ -268,10 +210,10 @@ class Transformer(nn.Module):
     def forward(self, src_seq, trg_seq):
 
         src_mask = get_pad_mask(src_seq, self.src_pad_idx)
-        trg_mask = get_pad_mask(trg_seq, self.trg_pad_idx) & get_subsequent_mask(trg_seq)
 
         enc_output, *_ = self.encoder(src_seq, src_mask)
-        dec_output, *_ = self.decoder(trg_seq, trg_mask, enc_output, src_mask)
+        trg_mask = get_trg_mask(trg_seq, self.trg_pad_idx)
+        dec_output, *_ = self.decoder(trg_seq, trg_mask, enc_output, src_mask, is_causal=trg_mask is None)
         seq_logit = self.trg_word_prj(dec_output)
         if self.scale_prj:
             seq_logit *= self.d_model ** -0.5
@@ -287,7 +229,7 @@ class VAETransformer(nn.Module):
             d_word_vec=512, d_model=512, d_latent=1024, d_inner=2048,
             n_layers=6, n_head=8, d_k=64, d_v=64, dropout=0.1, n_position=200,
             trg_emb_prj_weight_sharing=True, emb_src_trg_weight_sharing=True,
-            scale_emb_or_prj='prj'):
+            scale_emb_or_prj='prj', checkpoint_every=0):
 
         super().__init__()
 
@@ -313,13 +255,15 @@ class VAETransformer(nn.Module):
             n_src_vocab=n_src_vocab, n_position=n_position,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
             n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            pad_idx=src_pad_idx, dropout=dropout, scale_emb=scale_emb)
+            pad_idx=src_pad_idx, dropout=dropout, scale_emb=scale_emb,
+            checkpoint_every=checkpoint_every)
 
         self.decoder = Decoder(
             n_trg_vocab=n_trg_vocab, n_position=n_position,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
             n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            pad_idx=trg_pad_idx, dropout=dropout, scale_emb=scale_emb)
+            pad_idx=trg_pad_idx, dropout=dropout, scale_emb=scale_emb,
+            checkpoint_every=checkpoint_every)
 
         self.trg_word_prj = nn.Linear(d_model, n_trg_vocab, bias=False)
 
@@ -351,7 +295,6 @@ class VAETransformer(nn.Module):
 
     def forward(self, src_seq, trg_seq):
         src_mask = get_pad_mask(src_seq, self.src_pad_idx)
-        trg_mask = get_pad_mask(trg_seq, self.trg_pad_idx) & get_subsequent_mask(trg_seq)
 
         enc_output, *_ = self.encoder(src_seq, src_mask)
 
@@ -362,7 +305,8 @@ class VAETransformer(nn.Module):
 
         z_hidden = self.latent2hidden(z)
 
-        dec_output, *_ = self.decoder(trg_seq, trg_mask, z_hidden, src_mask)
+        trg_mask = get_trg_mask(trg_seq, self.trg_pad_idx)
+        dec_output, *_ = self.decoder(trg_seq, trg_mask, z_hidden, src_mask, is_causal=trg_mask is None)
 
         seq_logit = self.trg_word_prj(dec_output)
         if self.scale_prj:
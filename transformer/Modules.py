@@ -4,6 +4,87 @@ import torch.nn.functional as F
 
 __author__ = "Yu-Hsiang Huang"
 
+# -- device -> the causal mask of the longest length asked for so far
+_causal_masks = {}
+
+
+def get_causal_mask(len_s, device):
+    ''' 1 x len_s x len_s, position i only sees positions up to i. A view of a mask cached per device. '''
+    mask = _causal_masks.get(device)
+    if mask is None or mask.size(-1) < len_s:
+        mask = torch.ones((1, len_s, len_s), dtype=torch.bool, device=device).tril()
+        _causal_masks[device] = mask
+    return mask[:, :len_s, :len_s]
+
+
+def get_trg_mask(trg_seq, pad_idx):
+    '''
+    Decoder self attention mask of trg_seq: no subsequent positions and no padding.
+    None when trg_seq has no padding, as the causal part alone is then the whole mask and
+    the decoder can pass is_causal to the attention kernel instead of a mask tensor.
+    '''
+    if not (trg_seq == pad_idx).any():
+        return None
+    return (trg_seq != pad_idx).unsqueeze(-2) & get_causal_mask(trg_seq.size(1), trg_seq.device)
+
+
+def get_sinusoid_encoding(positions, d_hid):
+    ''' len(positions) x d_hid sinusoid encoding of a float tensor of positions. '''
+    hid_j = torch.arange(d_hid, device=positions.device)
+    angles = positions.unsqueeze(1) / torch.pow(10000.0, (2 * (hid_j // 2)).to(positions.dtype) / d_hid)
+    # dim 2i gets the sine, dim 2i+1 the cosine.
+    return torch.where(hid_j % 2 == 0, torch.sin(angles), torch.cos(angles))
+
+
+# -- (d_hid, device, dtype) -> sinusoid table of the most positions asked for so far
+_sinusoid_tables = {}
+
+
+def get_sinusoid_table(n_position, d_hid, device, dtype=torch.float):
+    '''
+    n_position x d_hid sinusoid position encoding, a view of a table
+    shared by every PositionalEncoding of that size, which grows on demand.
+    '''
+    key = (d_hid, device, dtype)
+    table = _sinusoid_tables.get(key)
+    if table is None or table.size(0) < n_position:
+        # Double at least, lengths that creep up one by one do not rebuild it every time.
+        n_rows = max(n_position, 2 * table.size(0) if table is not None else 0)
+        positions = torch.arange(n_rows, dtype=torch.float64)
+        table = get_sinusoid_encoding(positions, d_hid).to(device=device, dtype=dtype)
+        _sinusoid_tables[key] = table
+    return table[:n_position]
+
+
+class PositionalEncoding(nn.Module):
+    '''
+    Adds the sinusoid encoding of the positions. The table is shared and grows with
+    the longest input, n_position is only its initial size and no longer a limit.
+    '''
+
+    def __init__(self, d_hid, n_position=200):
+        super(PositionalEncoding, self).__init__()
+        self.d_hid = d_hid
+        self.n_position = n_position
+
+        # Checkpoints from before the shared table carry a pos_table buffer.
+        self._register_load_state_dict_pre_hook(self._drop_pos_table)
+
+    def _drop_pos_table(self, state_dict, prefix, *args):
+        state_dict.pop(prefix + 'pos_table', None)
+
+    def encode(self, positions):
+        ''' The encoding of a long tensor of positions, computed in the graph rather than looked up. '''
+        return get_sinusoid_encoding(positions.float(), self.d_hid)
+
+    def forward(self, x, start=0):
+        end = start + x.size(1)
+        if torch.jit.is_tracing():
+            # A traced graph would freeze the table at its current size, compute it for any length instead.
+            return x + self.encode(torch.arange(start, end, device=x.device)).to(x.dtype)
+        return x + get_sinusoid_table(max(end, self.n_position), self.d_hid, x.device, x.dtype)[start:end]
+
+
 class ScaledDotProductAttention(nn.Module):
     ''' Scaled Dot-Product Attention '''
 
@@ -0,0 +1,38 @@
+''' Dynamic int8 quantization of a trained model for CPU inference. '''
+import torch
+import torch.nn as nn
+from transformer.SubLayers import MultiHeadAttention, PositionwiseFeedForward
+
+
+def get_quantizable_names(model):
+    ''' The Linear layers of every attention and feed forward sublayer, and the output projection. '''
+    names = set()
+    for name, module in model.named_modules():
+        if isinstance(module, (MultiHeadAttention, PositionwiseFeedForward)):
+            names.update('{}.{}'.format(name, child_name)
+                         for child_name, child in module.named_children() if isinstance(child, nn.Linear))
+    if isinstance(getattr(model, 'trg_word_prj', None), nn.Linear):
+        names.add('trg_word_prj')
+    return names
+
+
+def quantize_dynamic_int8(model):
+    '''
+    Swap the quantizable Linear layers of model for dynamic int8 ones, in place.
+    Embeddings stay in float. When trg_word_prj is tied to trg_word_emb, the embedding keeps
+    the shared Parameter and the projection packs its int8 weight from that same tensor.
+    The fused query/key/value projections get split first, see MultiHeadAttention.split_qkv.
+    '''
+    model.eval()
+    for module in [module for module in model.modules() if isinstance(module, MultiHeadAttention)]:
+        module.split_qkv()
+    return torch.ao.quantization.quantize_dynamic(
+        model, get_quantizable_names(model), dtype=torch.qint8, inplace=True)
+
+
+def numeric_mode(model):
+    ''' The dtypes of the float parameters, plus int8 when quantize_dynamic_int8 was applied, e.g. float32+int8. '''
+    dtypes = sorted({str(p.dtype).replace('torch.', '') for p in model.parameters() if p.is_floating_point()})
+    if any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules()):
+        dtypes.append('int8')
+    return '+'.join(dtypes)
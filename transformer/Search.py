@@ -0,0 +1,256 @@
+''' Greedy and beam search over a decoding step, on torch tensors or on numpy arrays. '''
+
+
+class BeamSearch(object):
+    '''
+    The search loops of the translators. Subclasses run the model in
+    _init_state, _decode_step and _reorder_state, and provide the few array operations
+    below for their backend: torch in transformer.Translator, numpy in ort_translate.py.
+    They set alpha, beam_size, max_seq_len, max_len_a, max_len_b, early_stop
+    and the src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx ids.
+    '''
+
+    def _init_state(self, src_seq, src_mask, n_samples=None):
+        ''' What the decoding steps need besides the newest words, e.g. the key/value caches. '''
+        raise NotImplementedError
+
+    def _decode_step(self, words, src_mask, state):
+        '''
+        Log probabilities of the words following the newest ones, rows x vocabulary
+        or rows x the words of _get_word_ids. state gets updated.
+        '''
+        raise NotImplementedError
+
+    def _reorder_state(self, state, row_idx, enc_idx=None):
+        ''' Keep the row_idx rows of the decoded prefixes and the enc_idx rows of the sources. '''
+        raise NotImplementedError
+
+    def _get_word_ids(self, state):
+        '''
+        The word ids of the columns of the last _decode_step, one row per sentence,
+        or None when the columns are the whole vocabulary.
+        '''
+        return None
+
+    # -- Array operations, all of them on the device of like.
+
+    def _full_ids(self, shape, value, like):
+        raise NotImplementedError
+
+    def _full_scores(self, shape, value, like):
+        raise NotImplementedError
+
+    def _ids(self, values, like):
+        ''' A 1-d array of the integer values. '''
+        raise NotImplementedError
+
+    def _repeat_rows(self, x, n):
+        ''' Each row n times in a row. '''
+        raise NotImplementedError
+
+    def _max(self, x):
+        ''' (values, indices) of the maximum of each row. '''
+        raise NotImplementedError
+
+    def _topk(self, x, k):
+        ''' (values, indices) of the k largest of each row, largest first. '''
+        raise NotImplementedError
+
+    def _gather(self, x, idx):
+        ''' x[i, idx[i, j]] for every i, j. '''
+        raise NotImplementedError
+
+    def _masked_fill(self, x, mask, value):
+        raise NotImplementedError
+
+    def _nonzero(self, x):
+        ''' Indices of the non zero elements, one row of x.ndim indices each. '''
+        raise NotImplementedError
+
+
+    def _get_max_lens(self, src_seq):
+        ''' Decoding budget of every row: a * src_len + b, capped by max_seq_len. '''
+        if not (self.max_len_a or self.max_len_b):
+            return [self.max_seq_len] * len(src_seq)
+        src_lens = (src_seq != self.src_pad_idx).sum(1).tolist()
+        return [min(self.max_seq_len, max(2, int(self.max_len_a * src_len + self.max_len_b)))
+                for src_len in src_lens]
+
+
+    def greedy_decode(self, src_seq, n_samples=None, return_scores=False):
+        '''
+        Greedy decoding over a padded batch, rows leave the batch once they produce EOS.
+        See translate_batch for n_samples and return_scores.
+        '''
+
+        trg_bos_idx, trg_eos_idx = self.trg_bos_idx, self.trg_eos_idx
+
+        src_mask = (src_seq != self.src_pad_idx)[:, None, :]
+        state = self._init_state(src_seq, src_mask, n_samples)
+        if n_samples is not None:
+            src_seq = self._repeat_rows(src_seq, n_samples)
+            src_mask = self._repeat_rows(src_mask, n_samples)
+
+        batch_size = len(src_seq)
+        max_lens = self._get_max_lens(src_seq)
+        max_seq_len = max(max_lens)
+
+        gen_seq = self._full_ids((batch_size, max_seq_len), self.trg_pad_idx, src_seq)
+        gen_seq[:, 0] = trg_bos_idx
+        seq_lens = self._full_ids((batch_size,), max_seq_len, src_seq)
+        seq_scores = self._full_scores((batch_size,), 0, src_seq)
+        max_lens = self._ids(max_lens, src_seq)
+
+        # -- batch position of the rows still being decoded
+        active = self._ids(range(batch_size), src_seq)
+        words = gen_seq[:, 0]
+        for step in range(1, max_seq_len):
+            log_probs = self._decode_step(words, src_mask, state)
+            word_scores, words = self._max(log_probs)
+            word_ids = self._get_word_ids(state)
+            if word_ids is not None:
+                words = self._gather(word_ids, words[:, None])[:, 0]
+            gen_seq[active, step] = words
+            seq_scores[active] += word_scores
+
+            ended = (words == trg_eos_idx) | (max_lens[active] == step + 1)
+            if ended.any():
+                seq_lens[active[ended]] = step + 1
+                running = self._nonzero(~ended)[:, 0]
+                if len(running) == 0:
+                    break
+                active, words, src_mask = active[running], words[running], src_mask[running]
+                self._reorder_state(state, running, running)
+
+        seq_lens = seq_lens.tolist()
+        pred_seqs = [seq[:seq_len] for seq, seq_len in zip(gen_seq.tolist(), seq_lens)]
+        if return_scores:
+            # Normalized by length the same way as the beam search scores.
+            scores = [score / seq_len ** self.alpha for score, seq_len in zip(seq_scores.tolist(), seq_lens)]
+            return pred_seqs, scores
+        return pred_seqs
+
+
+    def translate_batch(self, src_seq, n_samples=None, return_scores=False):
+        '''
+        Beam search over a padded batch, returns the best hypothesis of each row.
+        With n_samples, each sentence is encoded once and decoded from n_samples latent samples,
+        which come out as n_samples consecutive hypotheses. With return_scores,
+        the length normalized log probabilities of the hypotheses come along.
+        '''
+
+        if self.beam_size == 1:
+            return self.greedy_decode(src_seq, n_samples, return_scores)
+
+        trg_bos_idx, trg_eos_idx = self.trg_bos_idx, self.trg_eos_idx
+        beam_size, alpha = self.beam_size, self.alpha
+
+        src_mask = (src_seq != self.src_pad_idx)[:, None, :]
+        # All the beams of a sentence share its projected encoder output.
+        state = self._init_state(src_seq, src_mask, n_samples)
+        if n_samples is not None:
+            # From here on each latent sample is a sentence of its own.
+            src_seq = self._repeat_rows(src_seq, n_samples)
+            src_mask = self._repeat_rows(src_mask, n_samples)
+
+        batch_size = len(src_seq)
+        max_lens = self._get_max_lens(src_seq)
+
+        # Each sentence owns beam_size consecutive rows, which start from BOS.
+        words = self._full_ids((batch_size * beam_size,), trg_bos_idx, src_seq)
+        beam_offsets = self._ids(range(beam_size), src_seq)
+
+        # Only the first beam is alive before the first step, the others are copies of it.
+        scores = self._full_scores((batch_size, beam_size), float('-inf'), src_seq)
+        scores[:, 0] = 0
+
+        # -- (words, rows of the previous step they extend) of every step, the back pointers
+        history = []
+        # -- original batch position of the sentences still being decoded
+        active = list(range(batch_size))
+        # -- (length normalized score, step, row, last word) of the finished hypotheses
+        finished = [[] for _ in range(batch_size)]
+        done = [False] * batch_size
+
+        for step in range(1, max(max_lens)):
+            n_active = len(active)
+            log_probs = self._decode_step(words, src_mask, state)
+            n_words = log_probs.shape[-1]
+
+            # Extend every beam with every scored word, n_active x (beam_size * n_words) candidates.
+            cand_scores = scores[:, :, None] + log_probs.reshape(n_active, beam_size, n_words)
+            # EOS takes at most beam_size of them, so 2 * beam_size always leaves beam_size to go on.
+            cand_scores, cand_idx = self._topk(cand_scores.reshape(n_active, -1), 2 * beam_size)
+            cand_beam, cand_word = cand_idx // n_words, cand_idx % n_words
+            word_ids = self._get_word_ids(state)
+            if word_ids is not None:
+                # The columns were the shortlisted words of each sentence.
+                cand_word = self._gather(word_ids, cand_word)
+            cand_eos = cand_word == trg_eos_idx
+
+            # Hypotheses ranked within the best beam_size candidates end here.
+            eos_locs = cand_eos[:, :beam_size] & (cand_scores[:, :beam_size] > float('-inf'))
+            for sent_i, cand_i in self._nonzero(eos_locs).tolist():
+                hyps = finished[active[sent_i]]
+                if len(hyps) < beam_size:
+                    row = sent_i * beam_size + cand_beam[sent_i, cand_i].item()
+                    score = cand_scores[sent_i, cand_i].item() / (step + 1) ** alpha
+                    hyps.append((score, step - 1, row, trg_eos_idx))
+
+            # The best beam_size candidates without EOS carry on.
+            scores, alive_idx = self._topk(self._masked_fill(cand_scores, cand_eos, float('-inf')), beam_size)
+            words = self._gather(cand_word, alive_idx).reshape(-1)
+            sent_offsets = self._ids(range(0, n_active * beam_size, beam_size), src_seq)
+            beam_rows = (sent_offsets[:, None] + self._gather(cand_beam, alive_idx)).reshape(-1)
+            history.append((words, beam_rows))
+
+            last_words, last_rows = None, None
+            for sent_i, sent_scores in enumerate(scores.tolist()):
+                idx = active[sent_i]
+                hyps = finished[idx]
+                if step == max_lens[idx] - 1:
+                    # Out of length, the unfinished beams compete as they are.
+                    # They point into the previous step since this one may get shrunk below.
+                    if last_words is None:
+                        last_words, last_rows = words.tolist(), beam_rows.tolist()
+                    for beam_i, score in enumerate(sent_scores):
+                        row = sent_i * beam_size + beam_i
+                        if len(hyps) < beam_size and score > float('-inf'):
+                            hyps.append((score / (step + 1) ** alpha, step - 1, last_rows[row], last_words[row]))
+                    done[idx] = True
+                elif len(hyps) >= beam_size:
+                    done[idx] = True
+                elif self.early_stop and hyps:
+                    # Log probabilities only go down, so the best a beam can still reach
+                    # is its current score spread over the whole budget.
+                    best_alive = sent_scores[0] / max_lens[idx] ** alpha
+                    done[idx] = max(hyp[0] for hyp in hyps) >= best_alive
+
+            # Drop the sentences which are done.
+            keep = [sent_i for sent_i, idx in enumerate(active) if not done[idx]]
+            if not keep:
+                break
+            enc_keep = None
+            if len(keep) < n_active:
+                active = [active[sent_i] for sent_i in keep]
+                enc_keep = self._ids(keep, src_seq)
+                keep_rows = (enc_keep[:, None] * beam_size + beam_offsets).reshape(-1)
+                scores, words, beam_rows = scores[enc_keep], words[keep_rows], beam_rows[keep_rows]
+                src_mask = src_mask[enc_keep]
+                history[-1] = (words, beam_rows)
+            self._reorder_state(state, beam_rows, enc_keep)
+
+        # Rebuild only the chosen hypotheses by following their back pointers.
+        history = [(words.tolist(), beam_rows.tolist()) for words, beam_rows in history]
+        pred_seqs, pred_scores = [], []
+        for hyps in finished:
+            score, step, row, last_word = max(hyps, key=lambda hyp: hyp[0])
+            pred_seq = []
+            for words, beam_rows in reversed(history[:step]):
+                pred_seq.append(words[row])
+                row = beam_rows[row]
+            pred_seqs.append([trg_bos_idx] + pred_seq[::-1] + [last_word])
+            pred_scores.append(score)
+        if return_scores:
+            return pred_seqs, pred_scores
+        return pred_seqs
@@ -0,0 +1,44 @@
+''' Candidate target words of each source sentence, the output layer only scores those. '''
+import pickle
+
+import torch
+
+
+class Shortlist(object):
+    '''
+    The candidates of a sentence are the frequent target words, the target words spelled
+    like its source tokens and the lexical translations of its source tokens,
+    out of a table written by build_shortlist.py.
+    '''
+
+    def __init__(self, table, trg_pad_idx, always=(), path=None):
+        self.lexical = table['lexical']
+        self.copy = table['copy']
+        self.trg_pad_idx = trg_pad_idx
+        self.path = path
+
+        self.base = set(table['frequent']) | set(always)
+        self.base.discard(trg_pad_idx)
+
+    @classmethod
+    def load(cls, path, trg_pad_idx, always=()):
+        with open(path, 'rb') as f:
+            table = pickle.load(f)
+        return cls(table, trg_pad_idx, always, path)
+
+    def get_candidates(self, src_seq):
+        ''' b x n_cand target ids, padded with trg_pad_idx which is never a candidate. '''
+        cand_lists = []
+        for src_ids in src_seq.tolist():
+            cands = set(self.base)
+            for src_idx in set(src_ids):
+                cands.update(self.lexical.get(src_idx, ()))
+                if src_idx in self.copy:
+                    cands.add(self.copy[src_idx])
+            cands.discard(self.trg_pad_idx)
+            cand_lists.append(sorted(cands))
+
+        n_cand = max(len(cands) for cands in cand_lists)
+        return torch.tensor(
+            [cands + [self.trg_pad_idx] * (n_cand - len(cands)) for cands in cand_lists],
+            dtype=torch.long, device=src_seq.device)
@@ -1,8 +1,9 @@
 ''' Define the sublayers in encoder/decoder layer '''
 import numpy as np
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from transformer.Modules import ScaledDotProductAttention
+from transformer.Modules import ScaledDotProductAttention, get_causal_mask
 
 __author__ = "Yu-Hsiang Huang"
 
@@ -16,9 +17,8 @@ class MultiHeadAttention(nn.Module):
         self.d_k = d_k
         self.d_v = d_v
 
-        self.w_qs = nn.Linear(d_model, n_head * d_k, bias=False)
-        self.w_ks = nn.Linear(d_model, n_head * d_k, bias=False)
-        self.w_vs = nn.Linear(d_model, n_head * d_v, bias=False)
+        # The query, key and value projections in one weight, n*dk + n*dk + n*dv rows.
+        self.w_qkv = nn.Linear(d_model, n_head * (2 * d_k + d_v), bias=False)
         self.fc = nn.Linear(n_head * d_v, d_model, bias=False)
 
         self.attention = ScaledDotProductAttention(temperature=d_k ** 0.5)
@@ -26,27 +26,120 @@ class MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
-
-    def forward(self, q, k, v, mask=None):
+        self._register_load_state_dict_pre_hook(self._fuse_qkv_state_dict)
+
+
+    def _fuse_qkv_state_dict(self, state_dict, prefix, *args):
+        ''' Checkpoints from before the fused projection have separate w_qs, w_ks and w_vs. '''
+        names = [prefix + name + '.weight' for name in ('w_qs', 'w_ks', 'w_vs')]
+        if all(name in state_dict for name in names):
+            state_dict[prefix + 'w_qkv.weight'] = torch.cat([state_dict.pop(name) for name in names])
+
+
+    def split_qkv(self):
+        '''
+        Replace w_qkv by w_q (the query rows) and w_kv (the key and value rows), done before dynamic
+        quantization: a quantized Linear only runs as a whole, while the cross attention projects
+        its queries alone at every decoding step and the encoder output's keys/values alone.
+        '''
+        n_q = self.n_head * self.d_k
+        weight = self.w_qkv.weight.detach()
+        self.w_q = nn.Linear(weight.size(1), n_q, bias=False)
+        self.w_kv = nn.Linear(weight.size(1), weight.size(0) - n_q, bias=False)
+        self.w_q.weight = nn.Parameter(weight[:n_q].clone())
+        self.w_kv.weight = nn.Parameter(weight[n_q:].clone())
+        del self.w_qkv
+
+
+    def _project(self, x, start, end):
+        ''' Rows start:end of the fused projection of x. '''
+        if hasattr(self, 'w_qkv'):
+            return F.linear(x, self.w_qkv.weight[start:end])
+        # Split by split_qkv, the rows come from the query or the key/value projection.
+        n_q = self.n_head * self.d_k
+        if end is not None and end <= n_q:
+            return self.w_q(x)[..., start:end]
+        return self.w_kv(x)[..., start - n_q:None if end is None else end - n_q]
+
+
+    def _project_qkv(self, x):
+        ''' Queries, keys and values of self attention, a single matmul unless split_qkv was called. '''
+        n_q, n_v = self.n_head * self.d_k, self.n_head * self.d_v
+        if hasattr(self, 'w_qkv'):
+            return self.w_qkv(x).split([n_q, n_q, n_v], dim=-1)
+        return (self.w_q(x),) + tuple(self.w_kv(x).split([n_q, n_v], dim=-1))
+
+
+    def project_kv(self, k, v):
+        ''' Pre-attention projection of keys and values: b x n x lk x dk, b x n x lv x dv '''
+
+        sz_b, len_k, len_v = k.size(0), k.size(1), v.size(1)
+        # The key rows follow the n*dk query rows, the value rows follow them.
+        n_qk = self.n_head * self.d_k
+
+        if k is v:
+            k, v = self._project(k, n_qk, None).split([n_qk, self.n_head * self.d_v], dim=-1)
+        else:
+            k, v = self._project(k, n_qk, 2 * n_qk), self._project(v, 2 * n_qk, None)
+        k = k.reshape(sz_b, len_k, self.n_head, self.d_k)
+        v = v.reshape(sz_b, len_v, self.n_head, self.d_v)
+        return k.transpose(1, 2), v.transpose(1, 2)
+
+
+    def forward(self, q, k, v, mask=None, cache=None, need_weights=True, is_causal=False):
+        '''
+        Without need_weights, attn comes back as None and the attention runs through
+        F.scaled_dot_product_attention when torch has it, which never materializes
+        the b x n x lq x lk probabilities.
+        With is_causal (self attention over a whole sequence, mask is None), each position
+        only attends to the earlier ones, a flag of that kernel instead of a mask tensor.
+        '''
 
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
-        sz_b, len_q, len_k, len_v = q.size(0), q.size(1), k.size(1), v.size(1)
+        sz_b, len_q = q.size(0), q.size(1)
 
         residual = q
 
-        # Pass through the pre-attention projection: b x lq x (n*dv)
-        # Separate different heads: b x lq x n x dv
-        q = self.w_qs(q).view(sz_b, len_q, n_head, d_k)
-        k = self.w_ks(k).view(sz_b, len_k, n_head, d_k)
-        v = self.w_vs(v).view(sz_b, len_v, n_head, d_v)
-
-        # Transpose for attention dot product: b x n x lq x dv
-        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+        if k is None:
+            # Keys/values already projected by project_kv, e.g. the encoder output while decoding.
+            k, v = cache['k'], cache['v']
+            q = self._project(q, 0, n_head * d_k)
+        else:
+            if q is k and k is v:
+                # Self attention, a single matmul projects the queries, keys and values.
+                q, k, v = self._project_qkv(q)
+                k = k.reshape(sz_b, -1, n_head, d_k).transpose(1, 2)
+                v = v.reshape(sz_b, -1, n_head, d_v).transpose(1, 2)
+            else:
+                k, v = self.project_kv(k, v)
+                q = self._project(q, 0, n_head * d_k)
+            if cache is not None:
+                # Incremental decoding: also attend to the keys/values of the earlier steps.
+                if 'k' in cache:
+                    k = torch.cat([cache['k'], k], dim=2)
+                    v = torch.cat([cache['v'], v], dim=2)
+                cache['k'], cache['v'] = k, v
+
+        # Separate different heads: b x lq x n x dk
+        # Several query rows (e.g. the beams of a sentence) may share one row of keys/values,
+        # they are folded into the query length instead of repeating the keys/values.
+        q = q.reshape(k.size(0), -1, n_head, d_k)
+
+        # Transpose for attention dot product: b x n x lq x dk
+        q = q.transpose(1, 2)
 
         if mask is not None:
             mask = mask.unsqueeze(1)   # For head axis broadcasting.
 
-        q, attn = self.attention(q, k, v, mask=mask)
+        if need_weights or not hasattr(F, 'scaled_dot_product_attention'):
+            if is_causal:
+                mask = get_causal_mask(len_q, q.device).unsqueeze(1)
+            q, attn = self.attention(q, k, v, mask=mask)
+        else:
+            dropout_p = self.attention.dropout.p if self.training else 0.0
+            q = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=None if mask is None else mask.bool(), dropout_p=dropout_p, is_causal=is_causal)
+            attn = None
 
         # Transpose to move the head dimension back: b x lq x n x dv
         # Combine the last two dimensions to concatenate all the heads together: b x lq x (n*dv)
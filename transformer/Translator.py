@@ -1,20 +1,32 @@
 ''' This module will handle the text generation with beam search. '''
 
+import json
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from transformer.TM_Models import VAETransformer, get_pad_mask, get_subsequent_mask
+from transformer.TM_Models import VAETransformer, get_subsequent_mask
+from transformer.Export import EncoderExport, DecoderStepExport
+from transformer.Search import BeamSearch
+
+try:
+    from torch.func import functional_call, stack_module_state, vmap
+except ImportError:
+    # Before torch 2.0, EnsembleTranslator runs its models one after the other.
+    vmap = None
 
 
-class Translator(nn.Module):
-    ''' Load a trained model and translate in beam search fashion. '''
+class Translator(BeamSearch, nn.Module):
+    ''' Load a trained model and translate in beam search fashion, see transformer.Search. '''
 
     # def __init__(
     #         self, opt, model, src_vocab_size, d_word_vec, beam_size, max_seq_len,
     #         src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx):
     def __init__(
             self, opt, model, beam_size, max_seq_len,
-            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx):
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            max_len_a=0, max_len_b=0, early_stop=False, shortlist=None):
         
 
         super(Translator, self).__init__()
@@ -23,106 +35,326 @@ class Translator(nn.Module):
         self.alpha = 0.7
         self.beam_size = beam_size
         self.max_seq_len = max_seq_len
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.early_stop = early_stop
         self.src_pad_idx = src_pad_idx
+        self.trg_pad_idx = trg_pad_idx
         self.trg_bos_idx = trg_bos_idx
         self.trg_eos_idx = trg_eos_idx
+        # -- transformer.Shortlist, when set only its candidates of each sentence get scored
+        self.shortlist = shortlist
 
         self.model = model
         self.model.eval()
 
-        self.register_buffer('init_seq', torch.LongTensor([[trg_bos_idx]]))
-        self.register_buffer(
-            'blank_seqs', 
-            torch.full((beam_size, max_seq_len), trg_pad_idx, dtype=torch.long))
-        self.blank_seqs[:, 0] = self.trg_bos_idx
-        self.register_buffer(
-            'len_map', 
-            torch.arange(1, max_seq_len + 1, dtype=torch.long).unsqueeze(0))
-
         # self.nmt_src_word_emb = nn.Embedding(src_vocab_size,d_word_vec,
         #                                      padding_idx=src_pad_idx)
 
 
-    def _model_decode(self, trg_seq, enc_output, src_mask):
-        trg_mask = get_subsequent_mask(trg_seq)
+    def _get_decoder(self):
+        # The tst/nmt heads belong to the two-headed DualVAETransformer of train_vae_split.py, which
+        # is not in transformer.Models yet. Until it is, no model here has them and -task_type must
+        # stay unset. Decoding both heads from one encoder pass waits for that model.
         if self.opt.task_type == 'tst':
-            dec_output, *_ = self.model.tst_decoder(trg_seq, trg_mask, enc_output, src_mask)
+            return self.model.tst_decoder
         elif self.opt.task_type == 'nmt':
-            dec_output, *_ = self.model.nmt_decoder(trg_seq, trg_mask, enc_output, src_mask)
+            return self.model.nmt_decoder
+        return self.model.decoder
+
+
+    def _model_decode(self, trg_seq, enc_output, src_mask, cache=None, cands=None):
+        # Decoding with a cache feeds one token at a time, which needs no subsequent mask.
+        trg_mask = None if cache is not None else get_subsequent_mask(trg_seq)
+        dec_output, *_ = self._get_decoder()(trg_seq, trg_mask, enc_output, src_mask, cache=cache)
+        # Only the last position is scored, in log space.
+        dec_output = dec_output[:, -1]
+        if cands is None:
+            return F.log_softmax(self.model.trg_word_prj(dec_output), dim=-1)
+        return self._project_candidates(dec_output, cands)
+
+
+    def _get_candidates(self, src_seq, n_samples=None):
+        '''
+        The shortlisted words of each sentence and their rows of trg_word_prj, gathered once per batch:
+        ids n_sent x n_cand, weight n_sent x d x n_cand, bias n_sent x n_cand.
+        '''
+        cand_ids = self.shortlist.get_candidates(src_seq)
+        if n_samples is not None:
+            cand_ids = cand_ids.repeat_interleave(n_samples, 0)
+        trg_word_prj = self.model.trg_word_prj
+        weight = trg_word_prj.weight[cand_ids]
+        if trg_word_prj.bias is not None:
+            bias = trg_word_prj.bias[cand_ids]
         else:
-            dec_output, *_ = self.model.decoder(trg_seq, trg_mask, enc_output, src_mask)
-        return F.softmax(self.model.trg_word_prj(dec_output), dim=-1)
+            bias = weight.new_zeros(cand_ids.size())
+        # The padding of cand_ids points at trg_pad_idx, which is never a candidate.
+        bias = bias.masked_fill(cand_ids.eq(self.trg_pad_idx), float('-inf'))
+        return {'ids': cand_ids, 'weight': weight.transpose(1, 2), 'bias': bias}
 
 
-    def _get_init_state(self, src_seq, src_mask):
-        beam_size = self.beam_size
-        # enc_output = self.nmt_src_word_emb(src_seq)
+    def _select_candidates(self, cands, enc_idx):
+        return {name: value[enc_idx] for name, value in cands.items()}
 
-        enc_output, *_ = self.model.encoder(src_seq, src_mask)
-        dec_output = self._model_decode(self.init_seq, enc_output, src_mask)
-        
-        best_k_probs, best_k_idx = dec_output[:, -1, :].topk(beam_size)
 
-        scores = torch.log(best_k_probs).view(beam_size)
-        gen_seq = self.blank_seqs.clone().detach()
-        gen_seq[:, 1] = best_k_idx[0]
-        enc_output = enc_output.repeat(beam_size, 1, 1)
-        return enc_output, gen_seq, scores
+    def _project_candidates(self, dec_output, cands):
+        ''' Log probabilities over the candidates of each sentence only, rows x n_cand. '''
+        n_sent, n_rows = cands['ids'].size(0), dec_output.size(0)
+        # n_sent x rows_per_sent x d  @  n_sent x d x n_cand
+        logits = torch.bmm(dec_output.view(n_sent, n_rows // n_sent, -1), cands['weight'])
+        logits = logits + cands['bias'].unsqueeze(1)
+        return F.log_softmax(logits, dim=-1).view(n_rows, -1)
 
 
-    def _get_the_best_score_and_idx(self, gen_seq, dec_output, scores, step):
-        assert len(scores.size()) == 1
-        
-        beam_size = self.beam_size
+    def _model_encode(self, src_seq, src_mask, n_samples=None):
+        ''' With n_samples, the encoder output comes out n_samples times per sentence, once per latent sample. '''
+        model = self.model
+        if hasattr(model, 'nmt_src_word_emb'):
+            # TM_Models.VAETransformer embeds the source outside of its encoder.
+            enc_input = model.nmt_src_word_emb(src_seq)
+            if model.scale_emb:
+                enc_input *= model.d_model ** 0.5
+            enc_output, *_ = model.encoder(enc_input, src_mask)
+        else:
+            enc_output, *_ = model.encoder(src_seq, src_mask)
+        if hasattr(model, 'latent2hidden'):
+            # The VAE decoders read the latent code, decode from the mean of its posterior
+            # or from samples of it, which share the encoder output.
+            z = model.hidden2mean(enc_output)
+            if n_samples is not None:
+                std = torch.exp(0.5 * model.hidden2logv(enc_output))
+                z, std = z.repeat_interleave(n_samples, 0), std.repeat_interleave(n_samples, 0)
+                z = z + torch.randn_like(std) * std
+            enc_output = model.latent2hidden(z)
+        elif n_samples is not None:
+            raise ValueError('Sampling needs a VAE model with a latent layer')
+        return enc_output
+
+
+    def _init_state(self, src_seq, src_mask, n_samples=None):
+        '''
+        What the decoding steps need besides the newest words:
+        the per-layer key/value caches and the shortlisted words of each sentence.
+        With n_samples, every sentence gets n_samples consecutive rows, one per latent sample.
+        '''
+        enc_output = self._model_encode(src_seq, src_mask, n_samples)
+        state = {'cache': self._get_decoder().init_cache(enc_output), 'cands': None}
+        if self.shortlist is not None:
+            state['cands'] = self._get_candidates(src_seq, n_samples)
+        return state
+
 
-        # Get k candidates for each beam, k^2 candidates in total.
-        best_k2_probs, best_k2_idx = dec_output[:, -1, :].topk(beam_size)
+    def _decode_step(self, words, src_mask, state):
+        ''' Log probabilities of the words following the newest ones, state gets updated. '''
+        return self._model_decode(words.unsqueeze(1), None, src_mask, state['cache'], state['cands'])
 
-        # Include the previous scores.
-        scores = torch.log(best_k2_probs).view(beam_size, -1) + scores.view(beam_size, 1)
 
-        # Get the best k candidates from k^2 candidates.
-        scores, best_k_idx_in_k2 = scores.view(-1).topk(beam_size)
- 
-        # Get the corresponding positions of the best k candidiates.
-        best_k_r_idxs, best_k_c_idxs = best_k_idx_in_k2 // beam_size, best_k_idx_in_k2 % beam_size
-        best_k_idx = best_k2_idx[best_k_r_idxs, best_k_c_idxs]
+    def _get_word_ids(self, state):
+        if state.get('cands') is None:
+            return None
+        return state['cands']['ids']
 
-        # Copy the corresponding previous tokens.
-        gen_seq[:, :step] = gen_seq[best_k_r_idxs, :step]
-        # Set the best tokens in this beam search step
-        gen_seq[:, step] = best_k_idx
 
-        return gen_seq, scores
+    def _reorder_state(self, state, row_idx, enc_idx=None):
+        ''' Keep the row_idx rows of the decoded prefixes and the enc_idx rows of the sources. '''
+        self._get_decoder().reorder_cache(state['cache'], row_idx, enc_idx)
+        if enc_idx is not None and state['cands'] is not None:
+            state['cands'] = self._select_candidates(state['cands'], enc_idx)
 
 
     def translate_sentence(self, src_seq):
         # Only accept batch size equals to 1 in this function.
-        # TODO: expand to batch operation.
         assert src_seq.size(0) == 1
+        return self.translate_batch(src_seq)[0]
 
-        src_pad_idx, trg_eos_idx = self.src_pad_idx, self.trg_eos_idx 
-        max_seq_len, beam_size, alpha = self.max_seq_len, self.beam_size, self.alpha 
 
+    def greedy_decode(self, src_seq, n_samples=None, return_scores=False):
         with torch.no_grad():
-            src_mask = get_pad_mask(src_seq, src_pad_idx)
-            enc_output, gen_seq, scores = self._get_init_state(src_seq, src_mask)
-
-            ans_idx = 0   # default
-            for step in range(2, max_seq_len):    # decode up to max length
-                dec_output = self._model_decode(gen_seq[:, :step], enc_output, src_mask)
-                gen_seq, scores = self._get_the_best_score_and_idx(gen_seq, dec_output, scores, step)
-
-                # Check if all path finished
-                # -- locate the eos in the generated sequences
-                eos_locs = gen_seq == trg_eos_idx   
-                # -- replace the eos with its position for the length penalty use
-                seq_lens, _ = self.len_map.masked_fill(~eos_locs, max_seq_len).min(1)
-                # -- check if all beams contain eos
-                if (eos_locs.sum(1) > 0).sum(0).item() == beam_size:
-                    # TODO: Try different terminate conditions.
-                    _, ans_idx = scores.div(seq_lens.float() ** alpha).max(0)
-                    ans_idx = ans_idx.item()
-                    break
-            # print(gen_seq)
-        return gen_seq[ans_idx][:seq_lens[ans_idx]].tolist()
+            return super(Translator, self).greedy_decode(src_seq, n_samples, return_scores)
+
+
+    def translate_batch(self, src_seq, n_samples=None, return_scores=False):
+        with torch.no_grad():
+            return super(Translator, self).translate_batch(src_seq, n_samples, return_scores)
+
+
+    def _full_ids(self, shape, value, like):
+        return torch.full(shape, value, dtype=torch.long, device=like.device)
+
+
+    def _full_scores(self, shape, value, like):
+        return torch.full(shape, value, dtype=torch.float, device=like.device)
+
+
+    def _ids(self, values, like):
+        return torch.tensor(list(values), dtype=torch.long, device=like.device)
+
+
+    def _repeat_rows(self, x, n):
+        return x.repeat_interleave(n, 0)
+
+
+    def _max(self, x):
+        return x.max(-1)
+
+
+    def _topk(self, x, k):
+        return x.topk(k, dim=1)
+
+
+    def _gather(self, x, idx):
+        return x.gather(1, idx)
+
+
+    def _masked_fill(self, x, mask, value):
+        return x.masked_fill(mask, value)
+
+
+    def _nonzero(self, x):
+        return x.nonzero()
+
+
+    def sample_batch(self, src_seq, n_samples):
+        '''
+        Diverse outputs of a VAE model: encode each sentence once, decode n_samples latent samples
+        of it in the same batch. Returns n_samples (pred_seq, score) pairs per sentence, best first.
+        '''
+        pred_seqs, scores = self.translate_batch(src_seq, n_samples, return_scores=True)
+        samples = list(zip(pred_seqs, scores))
+        return [sorted(samples[i:i + n_samples], key=lambda sample: sample[1], reverse=True)
+                for i in range(0, len(samples), n_samples)]
+
+
+class CompiledTranslator(Translator):
+    '''
+    Translate with the TorchScript encoder and decoding step written by export_model.py,
+    without building the Python model.
+    The gain is the startup, not the decoding. Measured by bench_translate.py -bench compiled
+    -no_cuda -n_repeat 10 on one CPU thread (6 layers, d_model 512, 32000 words, beam 5), loading
+    takes 270-400 ms vs 1600-1900 ms to build the eager model and load its checkpoint. A decoding step
+    takes 34-48 ms either way, the difference between the two (-20% to +8%) is within the noise
+    of the runs: the output projection and the matmuls dominate a step and tracing leaves them alone.
+    '''
+
+    def __init__(
+            self, opt, prefix, beam_size, max_seq_len,
+            max_len_a=0, max_len_b=0, early_stop=False, map_location=None):
+
+        with open(prefix + '.json') as f:
+            meta = json.load(f)
+
+        model = nn.Module()
+        model.encoder = torch.jit.load(prefix + '.encoder.pt', map_location=map_location)
+        model.decoder_step = torch.jit.load(prefix + '.decoder_step.pt', map_location=map_location)
+
+        super(CompiledTranslator, self).__init__(
+            opt, model, beam_size, max_seq_len,
+            meta['src_pad_idx'], meta['trg_pad_idx'], meta['trg_bos_idx'], meta['trg_eos_idx'],
+            max_len_a=max_len_a, max_len_b=max_len_b, early_stop=early_stop)
+
+
+    def _init_state(self, src_seq, src_mask, n_samples=None):
+        if n_samples is not None:
+            raise ValueError('The compiled encoder decodes from the latent mean only, sample with a -model checkpoint')
+        enc_k, enc_v = self.model.encoder(src_seq)
+        # The self attention caches are made at the first step, once the number of rows is known.
+        return {'enc_k': enc_k, 'enc_v': enc_v, 'slf_k': None, 'slf_v': None}
+
+
+    def _decode_step(self, words, src_mask, state):
+        enc_k, enc_v = state['enc_k'], state['enc_v']
+        if state['slf_k'] is None:
+            n_layers, _, n_head, _, d_k = enc_k.size()
+            state['slf_k'] = enc_k.new_zeros(n_layers, words.size(0), n_head, 0, d_k)
+            state['slf_v'] = enc_v.new_zeros(n_layers, words.size(0), n_head, 0, enc_v.size(-1))
+        step = torch.full((1,), state['slf_k'].size(3), dtype=torch.long, device=words.device)
+        log_probs, state['slf_k'], state['slf_v'] = self.model.decoder_step(
+            words, step, src_mask, enc_k, enc_v, state['slf_k'], state['slf_v'])
+        return log_probs
+
+
+    def _reorder_state(self, state, row_idx, enc_idx=None):
+        # The layers are stacked on the first dimension, rows come second.
+        if state['slf_k'] is not None:
+            state['slf_k'] = state['slf_k'].index_select(1, row_idx)
+            state['slf_v'] = state['slf_v'].index_select(1, row_idx)
+        if enc_idx is not None:
+            state['enc_k'] = state['enc_k'].index_select(1, enc_idx)
+            state['enc_v'] = state['enc_v'].index_select(1, enc_idx)
+
+
+class EnsembleTranslator(Translator):
+    '''
+    Translate with the mean word distribution of several models of the same architecture.
+    Their parameters are stacked, so every step runs all the models as one vectorized call.
+    The states carry the models on their first dimension.
+    '''
+
+    def __init__(
+            self, opt, models, beam_size, max_seq_len,
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            max_len_a=0, max_len_b=0, early_stop=False):
+
+        super(EnsembleTranslator, self).__init__(
+            opt, models[0], beam_size, max_seq_len,
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            max_len_a=max_len_a, max_len_b=max_len_b, early_stop=early_stop)
+
+        translators = [
+            Translator(opt, model, beam_size, max_seq_len, src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx)
+            for model in models]
+        self.encoders = [EncoderExport(translator) for translator in translators]
+        self.decoder_steps = [DecoderStepExport(translator) for translator in translators]
+        self.n_models = len(models)
+        self.encoder_state, self.decoder_step_state = None, None
+        if vmap is not None:
+            self.encoder_state = stack_module_state(self.encoders)
+            self.decoder_step_state = stack_module_state(self.decoder_steps)
+
+
+    def _run_models(self, modules, stacked_state, args, in_dims):
+        ''' Run every module on args, those with in_dim 0 hold one slice per model. Outputs are stacked. '''
+        if vmap is None:
+            outputs = [module(*[arg[i] if in_dim == 0 else arg for arg, in_dim in zip(args, in_dims)])
+                       for i, module in enumerate(modules)]
+            return tuple(torch.stack(output) for output in zip(*outputs))
+
+        def run(params, buffers, *args):
+            # The first module only provides the code, the weights come from the stacked state.
+            return functional_call(modules[0], (params, buffers), args)
+
+        return vmap(run, in_dims=(0, 0) + tuple(in_dims))(*stacked_state, *args)
+
+
+    def _init_state(self, src_seq, src_mask, n_samples=None):
+        if n_samples is not None:
+            raise ValueError('Ensembles decode from the latent mean only')
+        # -- n_models x n_layers x b x n x lk x dk
+        enc_k, enc_v = self._run_models(self.encoders, self.encoder_state, (src_seq,), (None,))
+        return {'enc_k': enc_k, 'enc_v': enc_v, 'slf_k': None, 'slf_v': None}
+
+
+    def _decode_step(self, words, src_mask, state):
+        enc_k, enc_v = state['enc_k'], state['enc_v']
+        if state['slf_k'] is None:
+            n_models, n_layers, _, n_head, _, d_k = enc_k.size()
+            state['slf_k'] = enc_k.new_zeros(n_models, n_layers, words.size(0), n_head, 0, d_k)
+            state['slf_v'] = enc_v.new_zeros(n_models, n_layers, words.size(0), n_head, 0, enc_v.size(-1))
+        step = torch.full((1,), state['slf_k'].size(4), dtype=torch.long, device=words.device)
+
+        log_probs, state['slf_k'], state['slf_v'] = self._run_models(
+            self.decoder_steps, self.decoder_step_state,
+            (words, step, src_mask, enc_k, enc_v, state['slf_k'], state['slf_v']),
+            (None, None, None, 0, 0, 0, 0))
+        # Average the probabilities, not the log probabilities.
+        return torch.logsumexp(log_probs, dim=0) - math.log(self.n_models)
+
+
+    def _reorder_state(self, state, row_idx, enc_idx=None):
+        # Models come first and layers second, rows are on the third dimension.
+        if state['slf_k'] is not None:
+            state['slf_k'] = state['slf_k'].index_select(2, row_idx)
+            state['slf_v'] = state['slf_v'].index_select(2, row_idx)
+        if enc_idx is not None:
+            state['enc_k'] = state['enc_k'].index_select(2, enc_idx)
+            state['enc_v'] = state['enc_v'].index_select(2, enc_idx)
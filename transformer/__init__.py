@@ -1,12 +1,26 @@
+import importlib.util
+
 import transformer.Constants
-import transformer.Modules
-import transformer.Layers
-import transformer.SubLayers
-import transformer.Models
-import transformer.Translator
-import transformer.Optim
-
-__all__ = [
-    transformer.Constants, transformer.Modules, transformer.Layers,
-    transformer.SubLayers, transformer.Models, transformer.Optim,
-    transformer.Translator]
+import transformer.Batching
+import transformer.Search
+
+__all__ = [transformer.Constants, transformer.Batching, transformer.Search]
+
+# ort_translate.py runs where PyTorch is not installed, with the modules above only.
+if importlib.util.find_spec('torch') is not None:
+    import transformer.Modules
+    import transformer.Layers
+    import transformer.SubLayers
+    import transformer.Models
+    import transformer.Translator
+    import transformer.Optim
+    import transformer.Cache
+    import transformer.Quantization
+    import transformer.Export
+    import transformer.Shortlist
+
+    __all__ += [
+        transformer.Modules, transformer.Layers,
+        transformer.SubLayers, transformer.Models, transformer.Optim,
+        transformer.Translator, transformer.Cache,
+        transformer.Quantization, transformer.Export, transformer.Shortlist]
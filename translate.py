@@ -1,5 +1,7 @@
 ''' Translate input text with trained model. '''
 import os
+import sys
+import copy
 import argparse
 import dill as pickle
 from tqdm import tqdm
@@ -7,9 +9,13 @@ from tqdm import tqdm
 import torch
 
 import transformer.Constants as Constants
-from torchtext.data import Dataset
-from transformer.Models import Transformer, VAETransformer, DualVAETransformer
-from transformer.Translator import Translator
+from transformer.Models import Transformer, VAETransformer
+from transformer.Translator import Translator, CompiledTranslator, EnsembleTranslator
+from transformer.Quantization import quantize_dynamic_int8, numeric_mode
+from transformer.Batching import token_budget_batches, pad_seqs
+from transformer.Cache import TranslationCache, checkpoint_identity
+from transformer.Shortlist import Shortlist
+from vocab import Vocab, load_vocab, load_examples
 
 
 def load_model(opt, device):
@@ -36,7 +42,7 @@ def load_model(opt, device):
             n_head=model_opt.n_head,
             dropout=model_opt.dropout).to(device)
         model.load_state_dict(checkpoint['model'])
-        print('[Info] Trained model state loaded.')
+        print('[Info] Trained model state loaded.', file=sys.stderr)
         return model
     else:
         model = Transformer(
@@ -57,79 +63,275 @@ def load_model(opt, device):
             n_head=model_opt.n_head,
             dropout=model_opt.dropout).to(device)
         model.load_state_dict(checkpoint['model'])
-        print('[Info] Trained model state loaded.')
+        print('[Info] Trained model state loaded.', file=sys.stderr)
         return model
 
 
 
+def pad_src_seqs(src_seqs, pad_idx):
+    return torch.LongTensor(pad_seqs(src_seqs, pad_idx))
+
+
+def translate_seqs(translator, src_seqs, opt, device):
+    ''' Translate in length-sorted batches, the predictions come back in the input order. '''
+    batches = token_budget_batches([len(seq) for seq in src_seqs], opt.max_tokens, opt.batch_size)
+
+    pred_seqs = [None] * len(src_seqs)
+    if opt.workers > 1:
+        for batch, batch_pred_seqs in translate_batches_forked(translator, batches, src_seqs, opt):
+            for i, pred_seq in zip(batch, batch_pred_seqs):
+                pred_seqs[i] = pred_seq
+        return pred_seqs
+
+    for batch in tqdm(batches, mininterval=2, desc='  - (Test)', leave=False):
+        src_seq = pad_src_seqs([src_seqs[i] for i in batch], opt.src_pad_idx).to(device)
+        for i, pred_seq in zip(batch, translator.translate_batch(src_seq)):
+            pred_seqs[i] = pred_seq
+    return pred_seqs
+
+
+# The translator of the forked workers, inherited from the parent instead of pickled.
+# Forked pages are shared copy-on-write, so the workers read the weights loaded by the parent.
+_worker_translator = None
+
+
+def _translate_in_worker(args):
+    batch, src_seqs, pad_idx = args
+    return batch, _worker_translator.translate_batch(pad_src_seqs(src_seqs, pad_idx))
+
+
+def translate_batches_forked(translator, batches, src_seqs, opt):
+    '''
+    Decode the batches in opt.workers forked CPU processes, which read the single copy
+    of the weights loaded by the parent rather than one copy each.
+    The parent has already run torch ops by now, and the OpenMP thread pool they started does not
+    survive the fork: a worker running more than one thread may hang. Each worker runs one thread,
+    the parallelism comes from the number of workers.
+    '''
+    global _worker_translator
+    _worker_translator = translator
+
+    ctx = torch.multiprocessing.get_context('fork')
+    jobs = [(batch, [src_seqs[i] for i in batch], opt.src_pad_idx) for batch in batches]
+    with ctx.Pool(opt.workers, initializer=torch.set_num_threads, initargs=(1,)) as pool:
+        # Batches finish out of order, the caller puts them back in place.
+        for result in tqdm(pool.imap_unordered(_translate_in_worker, jobs), total=len(jobs),
+                           mininterval=2, desc='  - (Test)', leave=False):
+            yield result
+
+
+def load_spm_tokenizer(model_path, lower):
+    ''' Tokenize raw text the way the SentencePiece fields of nmt_preprocess.py do. '''
+    import sentencepiece as spm
+
+    sp = spm.SentencePieceProcessor()
+    sp.Load(model_path)
+    sp.SetEncodeExtraOptions('bos:eos')
+
+    def tokenize(text):
+        pieces = sp.EncodeAsPieces(text)
+        return [piece.lower() for piece in pieces] if lower else pieces
+    return tokenize
+
+
+def detokenize(words):
+    ''' Join SentencePiece pieces back into text, plain tokens are joined by spaces. '''
+    specials = (Constants.BOS_WORD, Constants.EOS_WORD, '<s>', '</s>')
+    words = [word for word in words if word not in specials]
+    if any(word.startswith('\u2581') for word in words):
+        return ''.join(words).replace('\u2581', ' ').strip()
+    return ' '.join(words)
+
+
+def read_chunks(lines, chunk_size):
+    ''' Group the lines of a possibly endless stream, so only one chunk is held at a time. '''
+    chunk = []
+    for line in lines:
+        chunk.append(line.rstrip('\n'))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
 def main():
     '''Main Function'''
 
     parser = argparse.ArgumentParser(description='translate.py')
 
-    parser.add_argument('-model', required=True,
+    parser.add_argument('-model', default=None,
                         help='Path to model weight file')
-    parser.add_argument('-data_pkl', required=True,
+    parser.add_argument('-compiled', default=None,
+                        help='Prefix of the files written by export_model.py, used instead of -model. '
+                             'Starts about 5x faster, but a decoding step is no faster on CPU')
+    parser.add_argument('-ensemble', nargs='+', default=None,
+                        help='Checkpoints of one architecture to decode with together, used instead of -model')
+    parser.add_argument('-data_pkl', default=None,
                         help='Pickle file with both instances and vocabulary.')
+    parser.add_argument('-vocab_pkl', default=None,
+                        help='Vocabulary written by nmt_preprocess.py -save_vocab, used instead of -data_pkl')
+    parser.add_argument('-test_pkl', default=None,
+                        help='Test split written by nmt_preprocess.py -save_test, goes with -vocab_pkl')
     parser.add_argument('-output', default='output/pred_text',
                         help="""Path to output the predictions (each line will
                         be the decoded sequence""")
     parser.add_argument('-file_name', default=None)
     parser.add_argument('-beam_size', type=int, default=5)
     parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=0,
+                        help='Decode up to max_len_a * source length + max_len_b tokens, capped by max_seq_len')
+    parser.add_argument('-max_len_b', type=int, default=0)
+    parser.add_argument('-early_stop', action='store_true',
+                        help='Stop a sentence once no beam can beat its best finished hypothesis')
     parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-quantize', action='store_true',
+                        help='Dynamic int8 quantization of the attention, feed forward and output layers (CPU only)')
+    parser.add_argument('-shortlist', default=None,
+                        help='Table of build_shortlist.py, only score the candidate words of each sentence')
     parser.add_argument('-variational', action='store_true')
     parser.add_argument('-split', action='store_true')
     parser.add_argument('-task_type', type=str, default=None, choices=["tst", "nmt"])
 
-    # TODO: Translate bpe encoded files 
-    #parser.add_argument('-src', required=True,
-    #                    help='Source sequence to decode (one line per sequence)')
-    #parser.add_argument('-vocab', required=True,
-    #                    help='Source sequence to decode (one line per sequence)')
-    # TODO: Batch translation
-    #parser.add_argument('-batch_size', type=int, default=30,
-    #                    help='Batch size')
+    parser.add_argument('-src', default=None,
+                        help='Raw source text to decode (one line per sequence), - for stdin')
+    parser.add_argument('-spm_model', default=None,
+                        help='Source SentencePiece model for -src, taken from -vocab_pkl by default')
+    parser.add_argument('-chunk_size', type=int, default=1000,
+                        help='Lines of -src read, sorted and translated at a time')
+    parser.add_argument('-batch_size', type=int, default=30,
+                        help='Batch size')
+    parser.add_argument('-max_tokens', type=int, default=None,
+                        help='Padded source tokens per batch, sentences are sorted by length to fill it')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='Translate with this many forked single-threaded CPU processes, e.g. one per core, '
+                             'sharing one copy of the model')
+    parser.add_argument('-cache_size', type=int, default=0,
+                        help='Memoize up to this many translations of repeated sources')
+    parser.add_argument('-cache_file', default=None,
+                        help='Load the memoized translations from and save them to this file')
     #parser.add_argument('-n_best', type=int, default=1,
     #                    help="""If verbose is set, will output the n_best
     #                    decoded sentences""")
 
     opt = parser.parse_args()
     opt.cuda = not opt.no_cuda
+    if not (opt.model or opt.compiled or opt.ensemble):
+        parser.error('One of -model, -compiled or -ensemble is needed')
+    if opt.compiled and opt.quantize:
+        parser.error('-quantize applies to -model checkpoints only')
+    if opt.ensemble and (opt.quantize or opt.cache_size or opt.workers > 1):
+        parser.error('-ensemble does not combine with -quantize, -cache_size or -workers')
+    if opt.quantize and opt.cuda:
+        parser.error('-quantize runs on CPU only, add -no_cuda')
+    if opt.shortlist and (opt.compiled or opt.ensemble or opt.quantize):
+        parser.error('-shortlist applies to unquantized -model checkpoints only')
+    if opt.workers > 1 and (opt.cuda or opt.cache_size):
+        parser.error('-workers runs on CPU only (-no_cuda) and without -cache_size')
+
+    if not (opt.data_pkl or opt.vocab_pkl):
+        parser.error('One of -data_pkl or -vocab_pkl is needed')
 
-    data = pickle.load(open(opt.data_pkl, 'rb'))
-    SRC, TRG = data['vocab']['src'], data['vocab']['trg']
-    opt.src_pad_idx = SRC.vocab.stoi[Constants.PAD_WORD]
-    opt.trg_pad_idx = TRG.vocab.stoi[Constants.PAD_WORD]
-    opt.trg_bos_idx = TRG.vocab.stoi[Constants.BOS_WORD]
-    opt.trg_eos_idx = TRG.vocab.stoi[Constants.EOS_WORD]
+    if opt.vocab_pkl:
+        if not (opt.test_pkl or opt.src):
+            parser.error('-vocab_pkl needs -test_pkl or -src')
+        src_vocab, trg_vocab, settings = load_vocab(opt.vocab_pkl)
+        if opt.src:
+            spm_model = opt.spm_model or settings.get('src_spm_model')
+            if not spm_model:
+                parser.error('-src needs -spm_model, the vocabulary does not name one')
+            tokenize = load_spm_tokenizer(spm_model, lower=not settings.get('keep_case', False))
+        else:
+            test_examples = load_examples(opt.test_pkl)
+    else:
+        data = pickle.load(open(opt.data_pkl, 'rb'))
+        SRC, TRG = data['vocab']['src'], data['vocab']['trg']
+        src_vocab, trg_vocab = Vocab.from_field(SRC), Vocab.from_field(TRG)
+        test_examples = [{'src': example.src, 'trg': example.trg} for example in data['test']]
+        tokenize = SRC.preprocess
 
-    test_loader = Dataset(examples=data['test'], fields={'src': SRC, 'trg': TRG})
+    opt.src_pad_idx = src_vocab.stoi[Constants.PAD_WORD]
+    opt.trg_pad_idx = trg_vocab.stoi[Constants.PAD_WORD]
+    opt.trg_bos_idx = trg_vocab.stoi[Constants.BOS_WORD]
+    opt.trg_eos_idx = trg_vocab.stoi[Constants.EOS_WORD]
     
+    shortlist = None
+    if opt.shortlist:
+        shortlist = Shortlist.load(opt.shortlist, opt.trg_pad_idx, always=[opt.trg_eos_idx])
+
     device = torch.device('cuda' if opt.cuda else 'cpu')
-    translator = Translator(opt,
-                            model=load_model(opt, device),
-                            beam_size=opt.beam_size,
-                            max_seq_len=opt.max_seq_len,
-                            src_pad_idx=opt.src_pad_idx,
-                            trg_pad_idx=opt.trg_pad_idx,
-                            trg_bos_idx=opt.trg_bos_idx,
-                            trg_eos_idx=opt.trg_eos_idx).to(device)
-
-    unk_idx = SRC.vocab.stoi[SRC.unk_token]
-    with open(os.path.join(opt.output, opt.file_name), 'w') as f:
-        for example in tqdm(test_loader, mininterval=2, desc='  - (Test)', leave=False):
-            src_seq = [SRC.vocab.stoi.get(word, unk_idx) for word in example.src]
-            pred_seq = translator.translate_sentence(torch.LongTensor([src_seq]).to(device))
-            pred_line = ' '.join(TRG.vocab.itos[idx] for idx in pred_seq)
+    if opt.compiled:
+        translator = CompiledTranslator(opt, opt.compiled,
+                                        beam_size=opt.beam_size,
+                                        max_seq_len=opt.max_seq_len,
+                                        max_len_a=opt.max_len_a,
+                                        max_len_b=opt.max_len_b,
+                                        early_stop=opt.early_stop,
+                                        map_location=device)
+    elif opt.ensemble:
+        models = []
+        for path in opt.ensemble:
+            model_opt = copy.copy(opt)
+            model_opt.model = path
+            models.append(load_model(model_opt, device))
+        translator = EnsembleTranslator(opt,
+                                        models=models,
+                                        beam_size=opt.beam_size,
+                                        max_seq_len=opt.max_seq_len,
+                                        src_pad_idx=opt.src_pad_idx,
+                                        trg_pad_idx=opt.trg_pad_idx,
+                                        trg_bos_idx=opt.trg_bos_idx,
+                                        trg_eos_idx=opt.trg_eos_idx,
+                                        max_len_a=opt.max_len_a,
+                                        max_len_b=opt.max_len_b,
+                                        early_stop=opt.early_stop)
+    else:
+        model = load_model(opt, device)
+        if opt.quantize:
+            model = quantize_dynamic_int8(model)
+        translator = Translator(opt,
+                                model=model,
+                                beam_size=opt.beam_size,
+                                max_seq_len=opt.max_seq_len,
+                                src_pad_idx=opt.src_pad_idx,
+                                trg_pad_idx=opt.trg_pad_idx,
+                                trg_bos_idx=opt.trg_bos_idx,
+                                trg_eos_idx=opt.trg_eos_idx,
+                                max_len_a=opt.max_len_a,
+                                max_len_b=opt.max_len_b,
+                                early_stop=opt.early_stop,
+                                shortlist=shortlist).to(device)
+    if opt.cache_size:
+        checkpoint_path = opt.model or opt.compiled + '.decoder_step.pt'
+        translator = TranslationCache(translator, checkpoint_identity(checkpoint_path), numeric_mode(translator.model),
+                                      opt.cache_size, opt.cache_file)
+
+    f = open(os.path.join(opt.output, opt.file_name), 'w') if opt.file_name else sys.stdout
+    if opt.src:
+        # Stream the raw text through, chunk by chunk, in the order it comes.
+        src_file = sys.stdin if opt.src == '-' else open(opt.src)
+        for lines in read_chunks(src_file, opt.chunk_size):
+            src_seqs = [src_vocab.encode(tokenize(line)) for line in lines]
+            for pred_seq in translate_seqs(translator, src_seqs, opt, device):
+                f.write(detokenize(trg_vocab.decode(pred_seq)) + '\n')
+            f.flush()
+    else:
+        src_seqs = [src_vocab.encode(example['src']) for example in test_examples]
+        for pred_seq in translate_seqs(translator, src_seqs, opt, device):
+            pred_line = ' '.join(trg_vocab.decode(pred_seq))
             pred_line = pred_line.replace(Constants.BOS_WORD, '').replace(Constants.EOS_WORD, '')
             f.write(pred_line.strip() + '\n')
+    if f is not sys.stdout:
+        f.close()
+    if opt.cache_size:
+        translator.save()
+        print('[Info] Translation cache:', translator.stats(), file=sys.stderr)
 
-    print('[Info] Finished.')
+    print('[Info] Finished.', file=sys.stderr)
 
 if __name__ == "__main__":
     '''
     Usage: python translate.py -model trained.chkpt -data multi30k.pt -no_cuda
+           cat raw.txt | python translate.py -model trained.chkpt -vocab_pkl vocab.pkl -src - > pred.txt
     '''
     main()
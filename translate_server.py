@@ -0,0 +1,280 @@
+''' Serve a trained model over HTTP, decoding the requests that arrive close together as one batch. '''
+import sys
+import json
+import time
+import asyncio
+import argparse
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from transformer.Translator import Translator
+from transformer.Quantization import quantize_dynamic_int8, numeric_mode
+from transformer.Cache import TranslationCache, checkpoint_identity
+from translate import load_model, pad_src_seqs, load_spm_tokenizer, detokenize
+from vocab import load_vocab
+
+
+class BatchingTranslator(object):
+    ''' Gather concurrent requests for up to batch_window seconds and decode them together. '''
+
+    def __init__(self, translator, src_vocab, trg_vocab, tokenize, device,
+                 max_batch_size=30, batch_window=0.005, n_latencies=10000, cache=None):
+        self.translator = translator
+        self.cache = cache
+        self.src_vocab = src_vocab
+        self.trg_vocab = trg_vocab
+        self.tokenize = tokenize
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+
+        # The model decodes one batch at a time, off the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+        self.latencies = deque(maxlen=n_latencies)
+        self.n_sentences = 0
+        self.n_batches = 0
+        self.decode_time = 0.
+        self.start_time = time.time()
+
+
+    def start(self):
+        ''' Start batching, must be called from the running event loop. '''
+        self.queue = asyncio.Queue()
+        return asyncio.ensure_future(self._batch_loop())
+
+
+    async def translate(self, text):
+        start = time.time()
+        src_ids = self.src_vocab.encode(self.tokenize(text))
+        # A cache hit skips the batching window as well as the model.
+        pred_seq = self.cache.get(src_ids) if self.cache else None
+        if pred_seq is None:
+            future = asyncio.get_event_loop().create_future()
+            await self.queue.put((src_ids, future))
+            pred_seq = await future
+            if self.cache:
+                self.cache.put(src_ids, pred_seq)
+        self.latencies.append(time.time() - start)
+        return detokenize(self.trg_vocab.decode(pred_seq))
+
+
+    def _decode(self, src_seqs):
+        start = time.time()
+        with torch.no_grad():
+            src_seq = pad_src_seqs(src_seqs, self.translator.src_pad_idx).to(self.device)
+            pred_seqs = self.translator.translate_batch(src_seq)
+        self.decode_time += time.time() - start
+        return pred_seqs
+
+
+    async def _batch_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._decode_batch(batch)
+
+
+    async def _decode_batch(self, batch):
+        ''' Decode the batch, if it fails decode its requests one by one so only the failing ones fail. '''
+        loop = asyncio.get_event_loop()
+        try:
+            pred_seqs = await loop.run_in_executor(self.executor, self._decode, [seq for seq, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                for request in batch:
+                    await self._decode_batch([request])
+            elif not batch[0][1].done():
+                batch[0][1].set_exception(e)
+            return
+
+        self.n_batches += 1
+        self.n_sentences += len(batch)
+        for (_, future), pred_seq in zip(batch, pred_seqs):
+            if not future.done():
+                future.set_result(pred_seq)
+
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+        stats = {
+            'n_sentences': self.n_sentences,
+            'n_batches': self.n_batches,
+            'mean_batch_size': self.n_sentences / self.n_batches if self.n_batches else None,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p99_ms': percentile(0.99),
+            # -- sentences per second since start, and while the model was decoding
+            'throughput': self.n_sentences / (time.time() - self.start_time),
+            'decode_throughput': self.n_sentences / self.decode_time if self.decode_time else None}
+        if self.cache:
+            stats.update(self.cache.stats())
+        return stats
+
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+async def handle_http(batcher, reader, writer):
+    '''
+    POST /translate {"text": "..."} or {"text": ["...", ...]} -> {"translation": ...}
+    GET /stats -> latency and throughput counters
+    '''
+    try:
+        request_line = await reader.readline()
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        if method == 'GET' and path == '/stats':
+            status, payload = 200, batcher.stats()
+        elif method == 'POST' and path == '/translate':
+            request = json.loads(body.decode('utf-8'))
+            text = request.get('text') if isinstance(request, dict) else None
+            if not (isinstance(text, str) or isinstance(text, list) and all(isinstance(line, str) for line in text)):
+                raise ValueError('"text" must be a string or a list of strings')
+            if isinstance(text, list):
+                translation = list(await asyncio.gather(*[batcher.translate(line) for line in text]))
+            else:
+                translation = await batcher.translate(text)
+            status, payload = 200, {'translation': translation}
+        else:
+            status, payload = 404, {'error': 'Unknown endpoint {} {}'.format(method, path)}
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        status, payload = 400, {'error': str(e)}
+    except Exception as e:
+        # e.g. the model failed on the sentence, the client still gets an answer.
+        traceback.print_exc()
+        status, payload = 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                  'Connection: close\r\n\r\n').format(status, HTTP_REASONS[status], len(data)).encode('latin-1'))
+    writer.write(data)
+    await writer.drain()
+    writer.close()
+
+
+async def serve(batcher, opt):
+    batcher.start()
+
+    def handler(reader, writer):
+        return handle_http(batcher, reader, writer)
+
+    if opt.unix_socket:
+        server = await asyncio.start_unix_server(handler, path=opt.unix_socket)
+    else:
+        server = await asyncio.start_server(handler, opt.host, opt.port)
+    print('[Info] Serving on', opt.unix_socket or '{}:{}'.format(opt.host, opt.port), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    '''
+    Usage: python translate_server.py -model trained.chkpt -vocab_pkl vocab.pkl -port 8000
+           curl -d '{"text": "..."}' localhost:8000/translate
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-model', required=True,
+                        help='Path to model weight file')
+    parser.add_argument('-vocab_pkl', required=True,
+                        help='Vocabulary written by nmt_preprocess.py -save_vocab')
+    parser.add_argument('-spm_model', default=None,
+                        help='Source SentencePiece model, taken from -vocab_pkl by default')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=0)
+    parser.add_argument('-max_len_b', type=int, default=0)
+    parser.add_argument('-early_stop', action='store_true')
+    parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-quantize', action='store_true',
+                        help='Dynamic int8 quantization of the attention, feed forward and output layers (CPU only)')
+    parser.add_argument('-variational', action='store_true')
+    parser.add_argument('-split', action='store_true')
+    parser.add_argument('-task_type', type=str, default=None, choices=["tst", "nmt"])
+
+    parser.add_argument('-batch_size', type=int, default=30,
+                        help='Most requests decoded together')
+    parser.add_argument('-batch_window_ms', type=float, default=5,
+                        help='How long the first request of a batch waits for others to join')
+    parser.add_argument('-cache_size', type=int, default=0,
+                        help='Memoize up to this many translations of repeated sources')
+    parser.add_argument('-cache_file', default=None,
+                        help='Load the memoized translations from and save them to this file')
+    parser.add_argument('-host', default='127.0.0.1')
+    parser.add_argument('-port', type=int, default=8000)
+    parser.add_argument('-unix_socket', default=None,
+                        help='Listen on this Unix socket instead of -host/-port')
+
+    opt = parser.parse_args()
+    opt.cuda = not opt.no_cuda
+    if opt.quantize and opt.cuda:
+        parser.error('-quantize runs on CPU only, add -no_cuda')
+
+    src_vocab, trg_vocab, settings = load_vocab(opt.vocab_pkl)
+    spm_model = opt.spm_model or settings.get('src_spm_model')
+    if not spm_model:
+        parser.error('-spm_model is needed, the vocabulary does not name one')
+    tokenize = load_spm_tokenizer(spm_model, lower=not settings.get('keep_case', False))
+
+    device = torch.device('cuda' if opt.cuda else 'cpu')
+    model = load_model(opt, device)
+    if opt.quantize:
+        model = quantize_dynamic_int8(model)
+    translator = Translator(opt,
+                            model=model,
+                            beam_size=opt.beam_size,
+                            max_seq_len=opt.max_seq_len,
+                            src_pad_idx=src_vocab.pad_idx,
+                            trg_pad_idx=trg_vocab.pad_idx,
+                            trg_bos_idx=trg_vocab.bos_idx,
+                            trg_eos_idx=trg_vocab.eos_idx,
+                            max_len_a=opt.max_len_a,
+                            max_len_b=opt.max_len_b,
+                            early_stop=opt.early_stop).to(device)
+
+    cache = None
+    if opt.cache_size:
+        cache = TranslationCache(translator, checkpoint_identity(opt.model), numeric_mode(model),
+                                 opt.cache_size, opt.cache_file)
+
+    batcher = BatchingTranslator(
+        translator, src_vocab, trg_vocab, tokenize, device,
+        max_batch_size=opt.batch_size, batch_window=opt.batch_window_ms / 1000, cache=cache)
+    try:
+        asyncio.run(serve(batcher, opt))
+    except KeyboardInterrupt:
+        print('[Info] Stopped.', file=sys.stderr)
+    finally:
+        if cache:
+            cache.save()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+''' A small vocabulary artifact, so translation does not need to unpickle the whole dataset. '''
+import pickle
+
+
+class Vocab(object):
+    ''' Token/index mapping of one side, with the special tokens of its torchtext Field. '''
+
+    def __init__(self, itos, pad_token, unk_token, init_token, eos_token):
+        self.itos = itos
+        self.stoi = {word: idx for idx, word in enumerate(itos)}
+        self.pad_token, self.unk_token = pad_token, unk_token
+        self.init_token, self.eos_token = init_token, eos_token
+
+        self.pad_idx = self.stoi.get(pad_token)
+        self.unk_idx = self.stoi.get(unk_token, 0)
+        self.bos_idx = self.stoi.get(init_token)
+        self.eos_idx = self.stoi.get(eos_token)
+
+    @classmethod
+    def from_field(cls, field):
+        return cls(field.vocab.itos, field.pad_token, field.unk_token, field.init_token, field.eos_token)
+
+    def __len__(self):
+        return len(self.itos)
+
+    def encode(self, tokens):
+        return [self.stoi.get(word, self.unk_idx) for word in tokens]
+
+    def decode(self, seq):
+        return [self.itos[idx] for idx in seq]
+
+    def state_dict(self):
+        return {
+            'itos': list(self.itos),
+            'pad_token': self.pad_token, 'unk_token': self.unk_token,
+            'init_token': self.init_token, 'eos_token': self.eos_token}
+
+
+def save_vocab(path, src_vocab, trg_vocab, settings=None):
+    ''' Plain pickle of lists and strings, loading it needs neither torch nor torchtext. '''
+    data = {'settings': settings, 'src': src_vocab.state_dict(), 'trg': trg_vocab.state_dict()}
+    with open(path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_vocab(path):
+    ''' Returns the source Vocab, the target Vocab and the preprocessing settings. '''
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    return Vocab(**data['src']), Vocab(**data['trg']), data['settings']
+
+
+def save_examples(path, examples):
+    ''' Keep only the tokens of a split, e.g. the test set for translation. '''
+    data = [{'src': example.src, 'trg': example.trg} for example in examples]
+    with open(path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_examples(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)